@@ -1,25 +1,161 @@
 import logging
 import json
+import queue
 import sqlite3
+import threading
 
 try:
     from collections.abc import Iterable  # noqa
 except ImportError:
     from collections import Iterable # noqa
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Union
-from turbotape.helpers import iterate_resource
-from turbotape.records import Record
+from turbotape.helpers import iterate_resource_pages, json_loads, json_dumps
+from turbotape.records import Record, find_mediator, split_descriptor_parts
 
 log = logging.getLogger(__name__)
 
+# Size of the per-connection statement cache of the sqlite3 module. The
+# default of 128 is easily exhausted when several apps are cached at once.
+CACHED_STATEMENTS = 256
+
+# Number of rows that cache_app() collects before writing them to the database
+# with a single executemany() call.
+INSERT_BATCH_SIZE = 500
+
+# PRAGMAs that CachedItemStorage applies to its connection unless tune=False.
+# The cache is dominated by bulk inserts and point lookups, so we use WAL with
+# relaxed syncing, a 64 MB page cache and 256 MB of memory mapped I/O.
+TUNING_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA mmap_size=268435456',
+)
+
+# Number of pages cache_app() downloads ahead while it writes to the database.
+PREFETCH_PAGES = 4
+
+_END_OF_PAGES = object()
+
+
+def connect(database, **kwargs) -> sqlite3.Connection:
+    """
+    Open the SQLite database used by CachedItemStorage with a large
+    enough statement cache.
+    """
+    kwargs.setdefault('cached_statements', CACHED_STATEMENTS)
+    return sqlite3.connect(database, **kwargs)
+
+
+@lru_cache(maxsize=CACHED_STATEMENTS)
+def _table_name(app_id) -> str:
+    """
+    Name of the table that holds the cached items of one app.
+    """
+    return f'podio_app_{int(app_id):d}'
+
+
+@lru_cache(maxsize=CACHED_STATEMENTS)
+def _select_item_data_sql(app_id: int, columns: tuple, num_item_ids: int = 0) -> str:
+    """
+    Build the SELECT statement for the given app and WHERE columns.
+
+    The SQL text only depends on the shape of the query, so that the
+    sqlite3 module can reuse the already compiled statement.
+    """
+    table_name = _table_name(app_id)
+    where_clauses = [f'"{col}" = ?' for col in columns]
+    if num_item_ids > 0:
+        placeholders = ', '.join('?' * num_item_ids)
+        where_clauses.append(f'item_id IN ({placeholders})')
+    where_clauses_str = ' AND '.join(where_clauses)
+    return f'SELECT item_data FROM {table_name} WHERE {where_clauses_str}'
+
+
+@lru_cache(maxsize=CACHED_STATEMENTS)
+def _insert_item_data_sql(app_id: int, columns: tuple) -> str:
+    """
+    Build the INSERT OR REPLACE statement for the given app and columns.
+    """
+    table_name = _table_name(app_id)
+    column_names = ', '.join(columns)
+    placeholders = ', '.join('?' * len(columns))
+    return f'INSERT OR REPLACE INTO {table_name} ({column_names}) VALUES ({placeholders})'
+
+
+def _prefetch(iterable, maxsize=PREFETCH_PAGES):
+    """
+    Consume the iterable in a background thread and yield its elements. This way
+    the next pages are downloaded from the API while the current one is written
+    to the database (which has to happen in the thread that owns the connection).
+    """
+    page_queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(element):
+        while not stop.is_set():
+            try:
+                page_queue.put(element, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for element in iterable:
+                put(element)
+                if stop.is_set():
+                    return
+        finally:
+            put(_END_OF_PAGES)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(produce)
+        try:
+            while True:
+                element = page_queue.get()
+                if element is _END_OF_PAGES:
+                    break
+                yield element
+        finally:
+            stop.set()
+        # Re-raise any error that happened while downloading.
+        future.result()
+
+
+def _extract_field(fields_map: dict, field_descriptor: str):
+    """
+    Fetch a field value like Record.__getitem__() does, but look the field up
+    in a prepared {external_id: field} dictionary.
+    """
+    external_id, field_param = split_descriptor_parts(field_descriptor)
+    field = fields_map.get(external_id)
+    if not field:
+        return None
+    return find_mediator(field).fetch(field, field_param)
+
 
 class CachedItem(Record):
+    __slots__ = ('_item_storage', '_raw_data')
 
-    def __init__(self, item_storage, item_data):
+    def __init__(self, item_storage, item_data, raw_data=None):
         self._item_storage = item_storage
+        # The JSON document as it was read from the database. It is kept so that
+        # an unchanged item can be written back without serializing it again.
+        self._raw_data = raw_data
         super().__init__(item_data)
 
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._raw_data = None
+
+    def get_raw_data(self):
+        return self._raw_data
+
     def get_podio_session(self):
         return self._item_storage.podio
 
@@ -50,125 +186,189 @@ class CachedItemStorage(object):
     One object to connect a PodioOauth2Session and a SQLite3 database together.
 
     Example:
-    >>> import sqlite3
+    >>> from turbotape.cache import connect
     >>> from tetrapod.session import create_podio_session
     >>> podio = create_podio_session()
-    >>> conn = sqlite3.connect('database.sqlite3')
+    >>> conn = connect('database.sqlite3')
     >>> factory = CachedItemFactory(conn, podio)
     >>> factory.get_item(12929939)
     """
 
-    def __init__(self, conn:sqlite3.Connection, tape_session):
+    def __init__(self, conn:sqlite3.Connection, tape_session, tune=True):
         self.app_configs = {}
         self.conn = conn
         self.podio = tape_session
         self.cache_configs = {}
+        if tune is True:
+            self.tune_connection()
+
+    def tune_connection(self):
+        """
+        Apply the TUNING_PRAGMAS to the SQLite connection. Some of them can't be
+        changed inside a transaction, so a connection with an open transaction
+        is left as it is.
+        """
+        if self.conn.in_transaction:
+            log.warning('Not tuning the SQLite connection, it has an open transaction.')
+            return
+        for pragma in TUNING_PRAGMAS:
+            self.conn.execute(pragma)
 
     def _find_item_sql(self, sql, parameters):
         clean_params = []
         for param in parameters:
-            if isinstance(param, list):
+            # Related items are stored as their plain item_id, but accept the
+            # old way of passing them as a list with one item_id.
+            if isinstance(param, list) and len(param) == 1:
+                clean_params.append(param[0])
+            elif isinstance(param, list):
                 clean_params.append(repr(param))
             else:
                 clean_params.append(param)
+        # At most two rows are needed to tell whether the result is unique.
         cursor = self.conn.cursor()
-        cursor.execute(sql, clean_params)
-        found = cursor.fetchall()
-        cursor.close()
+        try:
+            cursor.execute(sql, clean_params)
+            first = cursor.fetchone()
+            second = cursor.fetchone() if first is not None else None
+        finally:
+            cursor.close()
 
-        if len(found) == 0:
+        if first is None:
             raise CachedItemNotFound(f'Item not found, SQL query: {sql}, '
                                      f'parameters: {repr(clean_params)}')
-        elif len(found) == 1:
-            item = CachedItem(self, json.loads(found[0][0]))
-            return item
-        elif len(found) >= 2:
-            raise Exception('Natural keys must be unique: %s' % repr(found))
+        elif second is not None:
+            raise Exception(f'Natural keys must be unique, SQL query: {sql}, '
+                            f'parameters: {repr(clean_params)}')
+        return CachedItem(self, json_loads(first[0]), raw_data=first[0])
 
     def get_item(self, app_id: int, item_id: int):
-        table_name = f'podio_app_{app_id}'
-
         cursor = self.conn.cursor()
-        sql = "SELECT item_data FROM %s WHERE item_id = ?" % table_name
+        sql = _select_item_data_sql(app_id, ('item_id',))
         vars = (item_id,)
         cursor.execute(sql, vars)
-        item_data = json.loads(cursor.fetchone()[0])
+        raw_data = cursor.fetchone()[0]
         cursor.close()
+        item_data = json_loads(raw_data)
 
-        item = CachedItem(item_storage=self, item_data=item_data)
+        item = CachedItem(item_storage=self, item_data=item_data, raw_data=raw_data)
         return item
 
     def get_item_by_join_ids(self, podio_app_id: int, select_for: dict):
-        table_name = f'podio_app_{podio_app_id:d}'
-        where_clauses = []
-        for key, val in select_for.items():
-            where_clauses.append(f'"{key}" = ?')
-        where_clauses_str = ' AND '.join(where_clauses)
-        sql = f"""SELECT item_data FROM {table_name} WHERE {where_clauses_str}"""
+        sql = _select_item_data_sql(podio_app_id, tuple(select_for.keys()))
         return self._find_item_sql(sql, list(select_for.values()))
 
     def get_referenced_item(self, podio_app_id: int, item_ids: Iterable, select_for: dict):
         """
         Find one item but only return it, if it is
         """
-        table_name = f'podio_app_{podio_app_id:d}'
-        where_clauses = []
-        for key, val in select_for.items():
-            where_clauses.append(f'"{key}" = ?')
-
         # Now restrict even further by the list of allowed item_ids
         if len(item_ids) == 0:
             raise CachedItemNotFound()
-        item_ids_str = ", ".join([f'{el:d}' for el in item_ids])
-        where_clauses.append(f'item_id IN ({(item_ids_str)})')
+        item_ids = [int(el) for el in item_ids]
+        # Round the number of placeholders up to the next power of two and pad
+        # with an item_id that never exists, so only a few statements get cached.
+        num_item_ids = 1 << (len(item_ids) - 1).bit_length()
+        item_ids += [-1] * (num_item_ids - len(item_ids))
 
-        # Put it together
-        where_clauses_str = ' AND '.join(where_clauses)
-        sql = f"""SELECT item_data FROM {table_name} WHERE {where_clauses_str}"""
-        return self._find_item_sql(sql, list(select_for.values()))
+        sql = _select_item_data_sql(podio_app_id, tuple(select_for.keys()), num_item_ids)
+        return self._find_item_sql(sql, list(select_for.values()) + item_ids)
 
     def get_item_by_natural_key(self, podio_app_id: int, key: Union[Iterable, str]) -> CachedItem:
-        if isinstance(key, Iterable):
-            key_val = '-'.join(key)
+        # Strings are iterable too, so check for the sequence types explicitly.
+        if isinstance(key, (list, tuple)):
+            key_val = '-'.join(map(str, key))
         else:
-            key_val = key
+            key_val = str(key)
 
-        table_name = f'podio_app_{podio_app_id:d}'
-        sql = f"""SELECT item_data FROM {table_name} WHERE __natural_key = ?"""
+        sql = _select_item_data_sql(podio_app_id, ('__natural_key',))
 
         return self._find_item_sql(sql, (key_val, ))
 
+    def _find_by_json_pattern(self, table_name: str, key: str, value) -> list:
+        """
+        Find items by a field value without needing an extra field column.
+
+        The stored JSON is first narrowed down with a LIKE pattern that matches
+        every row that contains the field's external_id followed by the value
+        somewhere. This may yield false positives, so the value of every
+        remaining item is checked again in Python. Only use it for field types
+        that store the value verbatim (e.g. text or category), not for numbers
+        or dates which the mediators reformat.
+        """
+        external_id, _ = split_descriptor_parts(key)
+        expected = '%s' % value
+
+        def escape_like(text):
+            return text.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+        # Search for the value the way it is escaped inside the stored JSON.
+        json_value = json_dumps(expected)[1:-1]
+        pattern = f'%{escape_like(json_dumps(external_id))}%{escape_like(json_value)}%'
+        sql = f"SELECT item_data FROM {table_name} WHERE item_data LIKE ? ESCAPE '!'"
+
+        cursor = self.conn.cursor()
+        cursor.execute(sql, (pattern, ))
+        found = cursor.fetchall()
+        cursor.close()
+
+        items = []
+        for row in found:
+            item_data = json_loads(row[0])
+            fields_map = {f['external_id']: f for f in item_data.get('fields', [])}
+            if '%s' % _extract_field(fields_map, key) == expected:
+                items.append(CachedItem(self, item_data, raw_data=row[0]))
+        return items
+
+    def get_item_by_field_value(self, podio_app_id: int, key: str, value) -> CachedItem:
+        """
+        Find exactly one item by the value of any field, even if it was not cached
+        as an extra field. This is slower than get_item_by_join_ids() because it has
+        to search the stored JSON, so use it for infrequent queries only.
+        """
+        table_name = _table_name(podio_app_id)
+        items = self._find_by_json_pattern(table_name, key, value)
+        if len(items) == 0:
+            raise CachedItemNotFound(f'Item not found in {table_name}: {key} = {value!r}')
+        elif len(items) >= 2:
+            raise Exception(f'Field value is not unique in {table_name}: {key} = {value!r}')
+        return items[0]
+
     def update_item(self, item: CachedItem):
-        app_id = item.get_item_data()['app']['app_id']
-        table_name = f'podio_app_{app_id}'
+        item_data = item.get_item_data()
+        app_id = item_data['app']['app_id']
+        table_name = _table_name(app_id)
         extra_fields = self.cache_configs[table_name]['extra_fields']
         natural_key_list = self.cache_configs[table_name]['natural_key']
 
-        self.insert_item_data_into_db(app_id, item.get_item_data(),
-                                      extra_fields, natural_key_list)
+        self.insert_item_data_into_db(app_id, item_data, extra_fields, natural_key_list,
+                                      commit=True, raw_data=item.get_raw_data())
 
     def create_item(self, app_id: int, item_values: dict):
-        table_name = f'podio_app_{app_id}'
+        table_name = _table_name(app_id)
         extra_fields = self.cache_configs[table_name]['extra_fields']
         natural_key_list = self.cache_configs[table_name]['natural_key']
         resp = self.podio.post(f'https://api.tapeapp.com/v1/record/app/{app_id:d}/',
                                json={'fields': item_values})
         resp.raise_for_status()
-        item_data = resp.json()
-        self.insert_item_data_into_db(app_id, item_data, extra_fields, natural_key_list)
+        item_data = json_loads(resp.content)
+        self.insert_item_data_into_db(app_id, item_data, extra_fields, natural_key_list,
+                                      commit=True)
         return CachedItem(self, item_data)
 
     def delete_item(self, app_id: int, item_id: int):
         raise NotImplementedError()
 
     def get_app_config(self, podio_app_id: int):
+        # The app_id can come from JSON as a string, always use the int as key.
+        app_id = int(podio_app_id)
         try:
-            return self.app_configs[podio_app_id]
+            return self.app_configs[app_id]
         except KeyError:
-            resp = self.podio.get(f'https://api.tapeapp.com/v1/app/{podio_app_id:d}/')
+            resp = self.podio.get(f'https://api.tapeapp.com/v1/app/{app_id:d}/')
             resp.raise_for_status()
-            config = resp.json()
-            self.app_configs[int(podio_app_id)] = config
+            config = json_loads(resp.content)
+            self.app_configs[app_id] = config
             return config
 
     def init_cache(self):
@@ -189,7 +389,7 @@ class CachedItemStorage(object):
         """
         Create a local copy of all the items in one app.
         """
-        table_name = 'podio_app_%d' % podio_app_id
+        table_name = _table_name(podio_app_id)
         natural_key_list = None
         if natural_key:
             if not isinstance(natural_key, list):
@@ -267,15 +467,34 @@ class CachedItemStorage(object):
         self.conn.execute(create_sql)
         self.conn.commit()
         url = "https://api.podio.com/item/app/%d/filter/" % podio_app_id
-        all_items = iterate_resource(self.podio, url, limit=300)
-        for item_data in all_items:
-            self.insert_item_data_into_db(podio_app_id, item_data, extra_fields, natural_key_list)
+        all_pages = iterate_resource_pages(self.podio, url, limit=300)
+
+        # Write all items in one transaction and in batches of INSERT_BATCH_SIZE rows.
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = None
+            rows = []
+            for page in _prefetch(all_pages):
+                for item_data in page:
+                    columns, values = self._row_for_insert(podio_app_id, item_data,
+                                                           extra_fields, natural_key_list)
+                    rows.append(values)
+                    if len(rows) >= INSERT_BATCH_SIZE:
+                        self._flush_rows(podio_app_id, columns, rows)
+                        rows = []
+            self._flush_rows(podio_app_id, columns, rows)
+        except BaseException:
+            # Don't keep the write lock, other writers would wait for it forever.
+            self.conn.rollback()
+            raise
 
         self.conn.commit()
         if natural_key_list:
+            # Items without a natural key must not collide with each other.
             idx_sql = \
                 f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{podio_app_id:d}_natural_key ' \
-                f'ON "{table_name}" (__natural_key)'
+                f'ON "{table_name}" (__natural_key) WHERE __natural_key IS NOT NULL'
             log.debug(idx_sql)
             try:
                 self.conn.execute(idx_sql)
@@ -283,21 +502,48 @@ class CachedItemStorage(object):
                 log.debug(err)
                 raise err
 
-    def insert_item_data_into_db(self, app_id, item_data,
-                                 extra_fields=None, natural_key_list=None):
-        table_name = f'podio_app_{app_id}'
+        # Index the extra fields, so that get_item_by_join_ids() and
+        # get_referenced_item() do not have to scan the whole table. The
+        # indexes are built after the bulk insert which is faster.
+        for field_name in extra_fields:
+            idx_sql = \
+                f'CREATE INDEX IF NOT EXISTS "idx_{podio_app_id:d}_{field_name}" ' \
+                f'ON "{table_name}" ("{field_name}")'
+            log.debug(idx_sql)
+            self.conn.execute(idx_sql)
+        if len(extra_fields) > 1:
+            extra_cols_sql = ', '.join(f'"{field_name}"' for field_name in extra_fields)
+            idx_sql = \
+                f'CREATE INDEX IF NOT EXISTS idx_{podio_app_id:d}_extra_fields ' \
+                f'ON "{table_name}" ({extra_cols_sql})'
+            log.debug(idx_sql)
+            self.conn.execute(idx_sql)
+
+        # Update the statistics so that the query planner picks the right index.
+        self.conn.execute(f'ANALYZE "{table_name}"')
+        self.conn.commit()
 
+    def _row_for_insert(self, app_id, item_data, extra_fields=None, natural_key_list=None,
+                        raw_data=None):
+        """
+        Return the column names and the values of the database row for one item.
+        If raw_data (the JSON document of item_data) is given, it is stored as-is.
+        """
         # Make sure that the Podio app ID is always included.
         try:
             item_data['app']['app_id']
         except KeyError:
             item_data['app'] = {'app_id': app_id}
+            raw_data = None
 
-        item = Item(item_data)
+        # Index the fields once, they are needed for the natural key and the extra fields.
+        fields_map = {f['external_id']: f for f in item_data.get('fields', [])}
 
         # item-ID and json-dump of the whole item go first.
         columns = ['item_id', 'item_data']
-        values = [item_data['item_id'], json.dumps(item_data)]
+        if raw_data is None:
+            raw_data = json_dumps(item_data)
+        values = [item_data['item_id'], raw_data]
 
         # determine the value of the natural key
         if natural_key_list:
@@ -306,11 +552,12 @@ class CachedItemStorage(object):
                 # TODO: This only works if the related app has only one
                 # natural key and the title of the app contains only that
                 # How do we deal with complex values?
-                if isinstance(item[key], dict):
-                    related = [item[key]['item_id']]
+                value = _extract_field(fields_map, key)
+                if isinstance(value, dict):
+                    related = [value['item_id']]
                     nat_key_val.append(repr(related))
                 else:
-                    nat_key_val.append('%s' % item[key])
+                    nat_key_val.append('%s' % value)
             values.append('-'.join(nat_key_val))
             columns.append('__natural_key')
 
@@ -319,20 +566,41 @@ class CachedItemStorage(object):
                 # TODO: This only works if the related app has only one
                 # natural key and the title of the app contains only that
                 # How do we deal with complex values?
-                if isinstance(item[field_name], dict):
-                    related = [item[key]['item_id']]
-                    values.append(repr(related))
-                    columns.append(f'"{field_name}"')
+                value = _extract_field(fields_map, field_name)
+                # References to a single related item are stored as the plain
+                # item_id, so that they can be looked up via the column's index.
+                if isinstance(value, list) and len(value) == 1:
+                    value = value[0]
+                if isinstance(value, dict):
+                    values.append(value['item_id'])
+                elif isinstance(value, int):
+                    values.append(value)
                 else:
-                    values.append('%s' % item[field_name])
-                    columns.append(f'"{field_name}"')
-
-        # create enough questionsmarks for the SQL
-        column_names = ', '.join(columns)
-        placeholders = ', '.join('?' * len(values))
-        sql = f'INSERT OR REPLACE INTO {table_name} ({column_names}) VALUES ({placeholders})'
-        self.conn.execute(
-            sql,
-            values
-        )
-        self.conn.commit()
+                    values.append('%s' % value)
+                columns.append(f'"{field_name}"')
+
+        return tuple(columns), values
+
+    def _flush_rows(self, app_id, columns: tuple, rows: list):
+        """
+        Write a batch of rows (as returned by _row_for_insert) into the app's table.
+        """
+        if len(rows) == 0:
+            return
+        sql = _insert_item_data_sql(app_id, columns)
+        cursor = self.conn.cursor()
+        cursor.executemany(sql, rows)
+        cursor.close()
+
+    def insert_item_data_into_db(self, app_id, item_data, extra_fields=None,
+                                 natural_key_list=None, commit=False, raw_data=None):
+        """
+        Insert (or replace) one item in the app's table. The transaction is only
+        committed if commit=True, otherwise it is left to the caller. Pass the
+        item's JSON document as raw_data to skip serializing item_data again.
+        """
+        columns, values = self._row_for_insert(app_id, item_data, extra_fields,
+                                               natural_key_list, raw_data)
+        self._flush_rows(app_id, columns, [values])
+        if commit is True:
+            self.conn.commit()
@@ -4,6 +4,7 @@ This module contains the command line interface for the 'tpod' command.
 '''
 import click
 import configparser
+import functools
 import json
 import os
 
@@ -13,6 +14,15 @@ from turbopod import podio_auth
 from turbopod.session import create_podio_session
 
 
+@functools.lru_cache(maxsize=1)
+def _session():
+    """
+    Create the Podio session only once per command, so that the token is read
+    and the TLS connection is set up only once.
+    """
+    return create_podio_session()
+
+
 @click.group()
 def cli():
     pass
@@ -42,7 +52,7 @@ def init(client_id, client_secret):
 
 @click.command(help='List your organisations')
 def orgs():
-    podio = create_podio_session()
+    podio = _session()
     orgas = podio.get('https://api.podio.com/org/').json()
     for org in orgas:
         click.echo(click.style(org['name'], bold=True) \
@@ -52,7 +62,7 @@ def orgs():
 @click.command(help='List all workspaces of an organization')
 @click.argument('organization')
 def spaces(organization):
-    podio = create_podio_session()
+    podio = _session()
     url = 'https://api.podio.com/space/org/{}/'.format(int(organization))
     spaces = podio.get(url).json()
     for space in spaces:
@@ -63,7 +73,7 @@ def spaces(organization):
 @click.command(help='List all apps of a workspace')
 @click.argument('space')
 def apps(space):
-    podio = create_podio_session()
+    podio = _session()
     url = 'https://api.podio.com/app/space/{}/'.format(int(space))
     apps = podio.get(url).json()
     for app in apps:
@@ -75,7 +85,7 @@ def apps(space):
 @click.argument('app_id')
 @click.argument('field')
 def add_app(app_id, field):
-    podio = create_podio_session()
+    podio = _session()
     url = 'https://api.podio.com/app/{:d}'.format(int(app_id))
     app = podio.get(url).json()
     space_id = app['space_id']
@@ -131,6 +141,7 @@ def deploy(space_name):
     app_id = config[app_section]['app_id']
     fields_raw = config[app_section]['fields']
     fields_all = [f.strip() for f in fields_raw.split(',')]
+    podio = _session()
     for fields in fields_all:
         field_section = '{}.{}.{}'.format(space_name, app_name, fields)
         field_id = config[field_section]['field_id']
@@ -153,7 +164,6 @@ def deploy(space_name):
         print(json.dumps(payload, indent=2))
 
         # Upload the payload
-        podio = create_podio_session()
         url = 'https://api.podio.com/app/{:d}/field/{:d}'.format(int(app_id), int(field_id))
         print(url)
         resp = podio.put(url, data=json.dumps(payload))
@@ -164,7 +174,7 @@ def deploy(space_name):
 @click.command(help="Get user info")
 @click.argument('user_id')
 def user(user_id):
-    podio = create_podio_session()
+    podio = _session()
     url = 'https://api.podio.com/user/{:d}'.format(int(user_id))
     print(url)
     resp = podio.get(url)
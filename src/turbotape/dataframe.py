@@ -1,12 +1,22 @@
-from turbopod.helpers import iterate_resource
-from turbopod.items import Item
+from turbotape.helpers import iterate_resource, json_loads
+from turbotape.records import find_mediator
 
 try:
+    import numpy as np   # type: ignore
     import pandas as pd   # type: ignore
 except ImportError as err:
     print("The module pandas is not installed. Run 'pip install pandas' or equivalent to install.")
     raise err
 
+def _field_positions(item_data, wanted):
+    """
+    Return the position of every wanted external_id within item_data['fields']
+    (or None if the item does not contain the field).
+    """
+    positions = {f['external_id']: pos for pos, f in enumerate(item_data.get('fields', []))}
+    return [positions.get(external_id) for external_id in wanted]
+
+
 def load_from_app(podio_session, app_id:int, limit:int=300,
                             external_ids:list=[], labels:list=[]):
     """
@@ -17,10 +27,10 @@ def load_from_app(podio_session, app_id:int, limit:int=300,
     """
     app_resp = podio_session.get('https://api.podio.com/app/{}/'.format(app_id))
     app_resp.raise_for_status()
-    app_data = app_resp.json()
+    app_data = json_loads(app_resp.content)
 
     url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
-    all_item_data = iterate_resource(podio_session, url, limit=limit)
+    all_item_data = list(iterate_resource(podio_session, url, limit=limit))
 
     if len(external_ids) > 0 and len(labels) > 0:
         raise ValueError('labels and external_ids cannot be used at the same time.')
@@ -35,13 +45,31 @@ def load_from_app(podio_session, app_id:int, limit:int=300,
             field_ids.append(field['external_id'])
             column_labels.append(field['external_id'])
 
-    all_rows = []
-    for item_data in all_item_data:
-        row = []
-        item = Item(item_data)
-        for field_id in field_ids:
-            row.append(item[field_id])
-        all_rows.append(row)
+    def fetch_value(field):
+        if field is None:
+            return None
+        return find_mediator(field).fetch(field, None)
+
+    # Items of one app usually list their fields in the same order, so look up
+    # the positions in the first item and only fall back to a search by
+    # external_id when an item differs.
+    positions = []
+    if len(all_item_data) > 0:
+        positions = _field_positions(all_item_data[0], field_ids)
 
-    return pd.DataFrame(all_rows, columns=column_labels)
+    # Fill one pre-allocated object array instead of building a list per row.
+    values = np.empty((len(all_item_data), len(field_ids)), dtype=object)
+    for row, item_data in enumerate(all_item_data):
+        fields = item_data.get('fields', [])
+        fields_map = None
+        for col, field_id in enumerate(field_ids):
+            pos = positions[col]
+            if pos is not None and pos < len(fields) and fields[pos]['external_id'] == field_id:
+                field = fields[pos]
+            else:
+                if fields_map is None:
+                    fields_map = {f['external_id']: f for f in fields}
+                field = fields_map.get(field_id)
+            values[row, col] = fetch_value(field)
 
+    return pd.DataFrame(values, columns=column_labels)
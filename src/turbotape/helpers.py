@@ -1,19 +1,56 @@
-import math
+import array
+import bisect
 import logging
 import mimetypes
+import sys
+import uuid
 
-from collections import UserList
-from functools import reduce
+from collections import OrderedDict, UserList, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain, islice
+from pathlib import Path
 
 from turbotape.records import Record
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+    import json
+
+try:
+    from requests_toolbelt import MultipartEncoder  # type: ignore
+except ImportError:
+    MultipartEncoder = None
+
 log = logging.getLogger(__name__)
 
 
+# json_loads() parses a JSON document given as str or bytes. It is bound
+# directly to the parser's loads() so the hot paths (one call per page) don't
+# pay for an extra Python function call.
+if orjson is not None:
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads
+
+
+def json_dumps(obj) -> str:
+    """
+    Serialize obj to a compact JSON string (orjson if available, json otherwise).
+    Keys that are not strings are converted like json does it.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    # Produce the same output as orjson, so the stored JSON can be searched.
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
 def iterate_array(client, url, http_method='GET', limit=100, offset=0, params=None):
     """
     Get a list of objects from the Podio API and provide a generator to iterate
-    over these items. Use this for 
+    over these items. Use list(iterate_array(...)) if you need a list. Use this for 
 
     e.g. to read all the items of one app use:
 
@@ -21,15 +58,13 @@ def iterate_array(client, url, http_method='GET', limit=100, offset=0, params=No
         for item in iterate_array(client, url, 'GET'):
             print(item)
     """
-    all_elements = []
     if params is None:
         params = dict(limit=limit, offset=offset)
     else:
         params['limit'] = limit
         params['offset'] = offset
         
-    do_requests = True
-    while do_requests == True:
+    while True:
         if http_method == 'POST':
             api_resp = client.post(url, data=params)
         elif http_method == 'GET':
@@ -40,28 +75,26 @@ def iterate_array(client, url, http_method='GET', limit=100, offset=0, params=No
         if api_resp.status_code != 200:
             raise Exception('Podio API response was bad: {}'.format(api_resp.content))
             
-        resp = api_resp.json()
-        num_entries = len(resp)
-        if num_entries < limit or num_entries <= 0:
-            do_requests = False
-
+        resp = json_loads(api_resp.content)
+        if not resp:
+            break
+        yield from resp
+        # A short page is the last one.
+        if len(resp) < limit:
+            break
         params['offset'] += limit
-        
-        all_elements.extend(resp) 
-    # print(f"array of {len(all_elements)}")
-    return all_elements
 
 
-def iterate_resource(client, url, http_method='POST', limit=500, offset=0, params=None):
+def iterate_resource_pages(client, url, http_method='POST', limit=500, offset=0, params=None,
+                           concurrency=8):
     """
-    Get a list of items from the Podio API and provide a generator to iterate
-    over these items.
-
-    e.g. to read all the items of one app use:
+    Generator that yields the items from the Podio API one page (a list of
+    at most `limit` items) at a time, so that the caller can process a page
+    while the next one is being requested.
 
-        url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
-        for item in iterate_resource(client, url, 'POST'):
-            print(item)
+    After the first response the offsets of all remaining pages are known, so
+    up to `concurrency` of them are requested at the same time. The pages are
+    still yielded in order.
     """
     if params is None:
         params = dict(limit=limit, offset=offset)
@@ -69,61 +102,236 @@ def iterate_resource(client, url, http_method='POST', limit=500, offset=0, param
         params['limit'] = limit
         params['offset'] = offset
 
-    if http_method == 'POST':
-        api_resp = client.post(url, json=params)
-    elif http_method == 'GET':
-        api_resp = client.get(url, params=params)
-    else:
+    if http_method not in ('POST', 'GET'):
         raise Exception("Method not supported.")
 
-    if api_resp.status_code != 200:
-        raise Exception('Podio API response was bad: {}'.format(api_resp.content))
-
-    all_items = []
-    resp = api_resp.json()
-    log.debug(f"Got {len(resp['items'])} ...")
-    all_items.extend(resp['items'])
-
-    total = resp['total']
-    try: 
-        total = resp['filtered']
-    except KeyError:
-        pass
-
-    log.debug('Getting items from offset: %d, total: %d' % (offset, total))
-    steps_left = []
-    if total > limit:
-        num_steps = int(math.ceil(total / limit))
-        steps = list(range(0, num_steps * limit, limit))
-        # we don't need step 0 because we already got the data.
-        steps_left = steps[1:]
-
-    for curr_offset in steps_left:
-        log.debug('Getting items from offset: %d, total: %d' % (curr_offset, total))
-        params['limit'] = limit
-        params['offset'] = curr_offset
+    def fetch_page(curr_offset):
+        page_params = dict(params, limit=limit, offset=curr_offset)
         if http_method == 'POST':
-            api_resp = client.post(url, json=params)
+            api_resp = client.post(url, json=page_params)
         else: # method == 'GET'
-            api_resp = client.get(url, params=params)
+            api_resp = client.get(url, params=page_params)
 
         if api_resp.status_code != 200:
             raise Exception('Podio API response was bad: {}'.format(api_resp.content))
-        resp = api_resp.json()
-        all_items.extend( resp['items'] )
+        return json_loads(api_resp.content)
+
+    resp = fetch_page(offset)
+    log.debug(f"Got {len(resp['items'])} ...")
+
+    total = resp.get('filtered', resp['total'])
+    yield resp['items']
+
+    log.debug('Getting items from offset: %d, total: %d' % (offset, total))
+    # we don't need the first step because we already got the data.
+    steps_left = range(limit, total, limit)
+
+    # Only keep `concurrency` pages in flight, so that memory stays bounded
+    # when the consumer is slower than the API.
+    concurrency = max(1, concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = deque()
+        offsets = iter(steps_left)
+        try:
+            for curr_offset in islice(offsets, concurrency):
+                futures.append(executor.submit(fetch_page, curr_offset))
+            while futures:
+                page = futures.popleft().result()
+                for curr_offset in islice(offsets, 1):
+                    log.debug('Getting items from offset: %d, total: %d' % (curr_offset, total))
+                    futures.append(executor.submit(fetch_page, curr_offset))
+                yield page['items']
+        finally:
+            # Don't wait for pages nobody is going to read anymore.
+            for future in futures:
+                future.cancel()
 
     log.debug("Got all items!")
-    return all_items
+
+
+def iterate_resource(client, url, http_method='POST', limit=500, offset=0, params=None,
+                     concurrency=8):
+    """
+    Get a list of items from the Podio API and provide a generator to iterate
+    over these items. The items are yielded page by page as they arrive, use
+    list(iterate_resource(...)) if you need a list.
+
+    e.g. to read all the items of one app use:
+
+        url = 'https://api.podio.com/item/app/{}/filter/'.format(app_id)
+        for item in iterate_resource(client, url, 'POST'):
+            print(item)
+    """
+    for page in iterate_resource_pages(client, url, http_method, limit, offset, params,
+                                       concurrency):
+        yield from page
 
 
 # We define intersection and union ourselves here,
 # so we don't have to depend on another module (e.g. fnc)
-def intersection(*args):
-    return reduce(lambda a, b: list(set(a) & set(b)), args)
+def _intersection_set(*args) -> set:
+    # Start with the shortest list, so there are fewer elements to look up,
+    # and stop as soon as nothing is left: intersecting an empty set with a
+    # list would still walk the whole list.
+    shortest, *others = sorted(args, key=len)
+    result = set(shortest)
+    for other in others:
+        if not result:
+            break
+        result.intersection_update(other)
+    return result
+
+
+def _union_set(*args) -> set:
+    return set(args[0]).union(*args[1:])
+
+
+def _merge_intersection(a, b) -> list:
+    # Walk both sorted sequences side by side, duplicates are dropped.
+    result = []
+    i, j = 0, 0
+    len_a, len_b = len(a), len(b)
+    while i < len_a and j < len_b:
+        x, y = a[i], b[j]
+        if x < y:
+            i += 1
+        elif y < x:
+            j += 1
+        else:
+            if not result or result[-1] != x:
+                result.append(x)
+            i += 1
+            j += 1
+    return result
+
+
+# Gallop through the longer sequence when it is this many times longer than the
+# shorter one, otherwise merge.
+GALLOP_RATIO = 32
+
+
+def _gallop_intersection(small, big) -> list:
+    # For every element of the short sequence, find its position in the long
+    # one by exponential search from the last position and then bisection:
+    # O(len(small) * log(len(big))) instead of O(len(small) + len(big)).
+    result = []
+    n = len(big)
+    lo = 0
+    for x in small:
+        if lo >= n:
+            break
+        if result and result[-1] == x:
+            continue
+        hi = lo
+        step = 1
+        while hi < n and big[hi] < x:
+            lo = hi + 1
+            hi = lo + step
+            step *= 2
+        lo = bisect.bisect_left(big, x, lo, min(hi, n))
+        if lo < n and big[lo] == x:
+            result.append(x)
+            lo += 1
+    return result
+
+
+def intersection_sorted(*args) -> list:
+    """
+    Intersect sequences that are sorted in ascending order (e.g. the index lists
+    of SearchableList) without hashing their elements. Returns a sorted list.
+    """
+    # Start with the shortest sequence and stop as soon as nothing is left.
+    shortest, *others = sorted(args, key=len)
+    result = list(shortest)
+    for other in others:
+        if not result:
+            break
+        if len(result) * GALLOP_RATIO < len(other):
+            result = _gallop_intersection(result, other)
+        else:
+            result = _merge_intersection(result, other)
+    return result
+
+
+def _intersect_postings(postings):
+    # The index lists of SearchableList are sorted. If the rarest search term
+    # is much rarer than all others, galloping through the long lists is
+    # cheaper than turning them into sets.
+    shortest = min(postings, key=len)
+    if len(postings) > 1 and all(len(shortest) * GALLOP_RATIO < len(other)
+           for other in postings if other is not shortest):
+        return intersection_sorted(*postings)
+    return _intersection_set(*postings)
+
+
+def intersection(*args, assume_sorted=False):
+    """
+    Return the elements that are in all of the given lists, in the order of the
+    first list. Pass assume_sorted=True if all lists are sorted ascending.
+    """
+    if assume_sorted:
+        return intersection_sorted(*args)
+    result = _intersection_set(*args)
+    # Return the elements in the order of the first argument.
+    return [el for el in dict.fromkeys(args[0]) if el in result]
 
 
 def union(*args):
-    return reduce(lambda a, b: list(set(a) | set(b)), args)
+    """
+    Return the elements that are in any of the given lists, without duplicates,
+    in the order they first appear.
+    """
+    return list(dict.fromkeys(chain.from_iterable(args)))
+
+
+# Values up to this length (e.g. categories) are cached and interned by
+# normalize_search_text(), longer free text is normalized every time.
+SHORT_SEARCH_TEXT = 64
+
+
+@lru_cache(maxsize=8192)
+def _normalize_short_search_text(text: str) -> str:
+    return sys.intern(text.strip().lower())
+
+
+def normalize_search_text(text: str) -> str:
+    """
+    Normalize a value for the search index. Many items share the same short
+    values (e.g. categories), so the results for those are cached and interned.
+    """
+    if len(text) <= SHORT_SEARCH_TEXT:
+        return _normalize_short_search_text(text)
+    return text.strip().lower()
+
+
+def search_terms(item: Record) -> list:
+    """
+    Return the (external_id, searchable_text) pairs of an item for the search index.
+    """
+    terms = []
+    for field in item.item_data['fields']:
+        # Every item repeats the same few external_ids, interning them lets all
+        # index lookups share one string object.
+        external_id = sys.intern(field['external_id'])
+        value = item[external_id]
+        if value is None or value == '':
+            continue
+        # Index every element of multi-value fields (e.g. related items) on its
+        # own instead of the repr() of the whole list.
+        if isinstance(value, (list, tuple)):
+            values = [el for el in value if el is not None and el != '']
+        else:
+            values = [value]
+        for el in values:
+            if not isinstance(el, str):
+                el = str(el)
+            terms.append((external_id, normalize_search_text(el)))
+    return terms
+
+
+def _item_data_search_terms(item_data: dict) -> list:
+    # Runs in the worker processes of load_complete_app().
+    return search_terms(Record(item_data))
 
 
 class SearchableList(UserList):
@@ -131,7 +339,11 @@ class SearchableList(UserList):
 
     def __init__(self, initlist=None):
         super().__init__(initlist)
-        self.search_index = {}
+        # {external_id: {searchable_text: [index, ...]}}
+        self.search_index = defaultdict(partial(defaultdict, list))
+        # {(mode, frozenset of (external_id, searchable_text)): indexes of the found items}
+        # Results of search_multiple(), cleared whenever an item is appended.
+        self._op_cache = OrderedDict()
 
     # stop deleltion from List
     def remove(self, s=None):
@@ -144,6 +356,17 @@ class SearchableList(UserList):
     def append(self, item: Record) -> None:
         index = len(self.data)  # index of appended element at end of list
         self.make_searchable(index, item)
+        self._op_cache.clear()
+        super().append(item)
+
+    def append_with_terms(self, item: Record, terms: list) -> None:
+        """Append an item whose search terms (see search_terms()) are already known."""
+        index = len(self.data)
+        for external_id, searchable_text in terms:
+            # Strings coming from worker processes are no longer interned.
+            external_id = sys.intern(external_id)
+            self.search_index[external_id][sys.intern(searchable_text)].append(index)
+        self._op_cache.clear()
         super().append(item)
 
     def insert(self, i: int, item: Record) -> None:
@@ -151,22 +374,26 @@ class SearchableList(UserList):
 
     def make_searchable(self, index: int, item: Record):
         """Create the searchable values for the item in the search index."""
-        for field in item.item_data['fields']:
-            external_id = field['external_id']
-            searchable_text = str(item[external_id]).strip().lower()
-            try:
-                index_for_field = self.search_index[external_id]
-            except KeyError:
-                index_for_field = {}
-                self.search_index[external_id] = index_for_field
-            if searchable_text in index_for_field.keys():
-                index_for_field[searchable_text] += [index]
-            else:
-                index_for_field[searchable_text] = [index]
+        for external_id, searchable_text in search_terms(item):
+            self.search_index[external_id][searchable_text].append(index)
 
     SEARCH_AND = 1
     SEARCH_OR = 2
 
+    # Number of search_multiple() results remembered per list.
+    OP_CACHE_SIZE = 1024
+
+    def finalize(self):
+        """
+        Convert the lists of indexes in the search index to compact integer
+        arrays. Call this after all items have been appended, appending more
+        items afterwards still works.
+        """
+        for index_for_field in self.search_index.values():
+            for searchable_text, index_list in index_for_field.items():
+                if isinstance(index_list, list):
+                    index_for_field[searchable_text] = array.array('i', index_list)
+
     def search_multiple(self, external_ids_and_search_terms: dict, mode=SEARCH_AND):
         """
         Example:
@@ -183,49 +410,68 @@ class SearchableList(UserList):
         if len(self.data) == 0:
             log.warning('Tried search in empty list.')
             return []
-        for external_id in external_ids_and_search_terms.keys():
-            if external_id not in self.search_index.keys():
+        for external_id in external_ids_and_search_terms:
+            if external_id not in self.search_index:
                 log.warning('Searching for unknown field "%s", field might be null for '
                             'every item in this list or not exist at all.' % external_id)
                 if mode == self.SEARCH_AND:
                     return []
 
-        results_indexes = []  # list of lists of indexes of items found
-        for external_id, search_term in external_ids_and_search_terms.items():
-            query = str(search_term).strip().lower()
-            field_data = self.search_index[external_id]
-            try:
-                index_list = field_data[query]  # returns a list of indexes
-                results_indexes.append(index_list)
-            except KeyError:
-                results_indexes.append([])
-        # the final result is the indexes that were found for every search term
-        if mode == self.SEARCH_AND:
-            final_result_indexes = list(intersection(*results_indexes))
-        elif mode == self.SEARCH_OR:
-            final_result_indexes = list(union(*results_indexes))
+        terms = frozenset((external_id, normalize_search_text(str(search_term)))
+                          for external_id, search_term in external_ids_and_search_terms.items())
+        cache_key = (mode, terms)
+        final_result_indexes = self._op_cache.get(cache_key)
+        if final_result_indexes is not None:
+            self._op_cache.move_to_end(cache_key)
+        else:
+            results_indexes = []  # list of lists of indexes of items found
+            for external_id, query in terms:
+                # Use .get() so that searching does not add empty entries to the index.
+                field_data = self.search_index.get(external_id, {})
+                indexes = field_data.get(query, [])  # a list of indexes
+                if mode == self.SEARCH_AND and len(indexes) == 0:
+                    # One search term without matches is enough for an empty result,
+                    # skip looking up the rest and intersecting.
+                    results_indexes = [indexes]
+                    break
+                results_indexes.append(indexes)
+            # the final result is the indexes that were found for every search term
+            if mode == self.SEARCH_AND:
+                final_result_indexes = _intersect_postings(results_indexes)
+            elif mode == self.SEARCH_OR:
+                final_result_indexes = _union_set(*results_indexes)
+            self._op_cache[cache_key] = final_result_indexes
+            if len(self._op_cache) > self.OP_CACHE_SIZE:
+                self._op_cache.popitem(last=False)
 
         result_items = [self.data[idx] for idx in final_result_indexes]
         return result_items
 
+    def search_batch(self, queries: list, mode=SEARCH_AND) -> list:
+        """
+        Run many search_multiple() queries at once, e.g. during a bulk sync.
+        Every query is normalized and cached exactly like in search_multiple(),
+        so queries that repeat within the batch are only looked up once.
+
+        :param queries: A list of dicts like the one search_multiple() takes.
+        :return: A list with one list of found items per query.
+        """
+        return [self.search_multiple(query, mode=mode) for query in queries]
+
     def search(self, external_id: str, look_for: str) -> list:
         if len(self.data) == 0:
             log.warning('Tried search in empty list.')
             return []
-        if external_id not in self.search_index.keys():
+        if external_id not in self.search_index:
             log.warning('Searching for unknown field "%s", field might be null for '
                         'every item in this list or not exist at all.' % external_id)
             return []
         query = str(look_for).strip().lower()
         search_results = []
-        field_data = self.search_index[external_id]
-        try:
-            index_list = field_data[query]
-            # Use the sorted index
-            for index in sorted(index_list):
-                search_results.append(self.data[index])
-        except KeyError:
-            pass
+        index_list = self.search_index[external_id].get(query, [])
+        # Items are only ever appended, so the indexes are already sorted.
+        for index in index_list:
+            search_results.append(self.data[index])
         return search_results
 
     def search_first(self, external_id: str, look_for: str) -> Record:
@@ -237,31 +483,94 @@ class SearchableList(UserList):
             return items_found[0]
 
 
-def load_complete_app(podio, app_id):
+def load_complete_app(podio, app_id, processes=None):
+    """
+    Load all items of an app into a SearchableList.
+
+    By default the search index is built while the pages are downloaded. For
+    big apps pass processes=N to download everything first and then extract
+    the search terms in N worker processes.
+    """
     url = f'https://api.podio.com/item/app/{app_id}/filter/'
 
     payload = SearchableList()
-    for record in iterate_resource(podio, url, 'POST', limit=250):
-        payload.append(Record(record))
+    if processes is None or processes < 2:
+        for record in iterate_resource(podio, url, 'POST', limit=250):
+            payload.append(Record(record))
+    else:
+        all_records = list(iterate_resource(podio, url, 'POST', limit=250))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            all_terms = executor.map(_item_data_search_terms, all_records, chunksize=256)
+            for record, terms in zip(all_records, all_terms):
+                payload.append_with_terms(Record(record), terms)
+    payload.finalize()
+    # Release the memory of the normalized values, the index keeps its own references.
+    _normalize_short_search_text.cache_clear()
 
     return payload
 
 
+# Read the system's mime.types once at import instead of on the first upload.
+mimetypes.init()
+
+
+@lru_cache(maxsize=512)
+def guess_mimetype(suffixes: str):
+    """
+    Return the mimetype for the suffixes of a file name like '.pdf' or
+    '.tar.gz', or None if unknown.
+    """
+    return mimetypes.guess_type('file' + suffixes)[0]
+
+
 def upload_file(tape_session, record_id, file_field, raw_data, new_file_name, replace_file_field=True):
     """
     If replace_file_field == True, the file field will be replaced in-place.
+
+    raw_data can be bytes or a file object opened in binary mode. If it is a
+    file object and requests-toolbelt is installed, the file is streamed in
+    chunks instead of building the whole multipart body in memory. Retries
+    send the file again from the position it had when upload_file was called.
     """
     if replace_file_field is True:
         log.info(f'Uploading and attaching/replacing file {new_file_name} to record {record_id}')
     else:
         log.info(f'Uploading file {new_file_name}')
-    files = {'file': (new_file_name, raw_data, mimetypes.guess_type(new_file_name)[0])}
-    data = {'filename': new_file_name.encode('utf-8')}
-    upload_resp = tape_session.post('https://api.tapeapp.com/v1/file/upload', data=data, files=files)
+    url = 'https://api.tapeapp.com/v1/file/upload'
+    mimetype = guess_mimetype(''.join(Path(new_file_name).suffixes).lower())
+    if MultipartEncoder is not None and hasattr(raw_data, 'read'):
+        start = raw_data.tell()
+        boundary = uuid.uuid4().hex
+
+        def make_encoder():
+            raw_data.seek(start)
+            return MultipartEncoder(fields={
+                'filename': new_file_name,
+                'file': (new_file_name, raw_data, mimetype),
+            }, boundary=boundary)
+
+        # A streamed body is used up after one attempt. Sessions that support
+        # it (TapeSession) build a new one from the start of the file for every
+        # retry, other sessions get a single encoder.
+        if getattr(tape_session, 'accepts_body_factory', False) is True:
+            body = make_encoder
+        else:
+            body = make_encoder()
+        upload_resp = tape_session.post(
+            url, data=body,
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    else:
+        if hasattr(raw_data, 'read'):
+            # requests builds the multipart body in memory anyway, reading the
+            # file once keeps retries from sending an empty file.
+            raw_data = raw_data.read()
+        files = {'file': (new_file_name, raw_data, mimetype)}
+        data = {'filename': new_file_name.encode('utf-8')}
+        upload_resp = tape_session.post(url, data=data, files=files)
     log.debug(f"Upload response is: {upload_resp.status_code}, "
              f"content(-repr): {repr(upload_resp.content)}")
     upload_resp.raise_for_status()
-    upload_resp_content = upload_resp.json()
+    upload_resp_content = json_loads(upload_resp.content)
     new_file_id = upload_resp_content['file_id']
 
     if replace_file_field is True:
@@ -275,3 +584,35 @@ def upload_file(tape_session, record_id, file_field, raw_data, new_file_name, re
                 f"content(-repr): {repr(upload_resp.content)}")
         attach_resp.raise_for_status()
     return upload_resp_content
+
+
+def upload_files(tape_session, jobs, concurrency=8):
+    """
+    Upload many files at once. Every job is a tuple of the arguments of
+    upload_file() after the session, i.e.
+    (record_id, file_field, raw_data, new_file_name[, replace_file_field]).
+
+    Up to `concurrency` uploads run at the same time. Keep it low enough to stay
+    within the API's rate limits. Returns the upload responses in job order.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(upload_file, tape_session, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def save_records(records, tape_session=None, concurrency=8):
+    """
+    Save many records at once, e.g. after a bulk update. Up to `concurrency`
+    records are sent at the same time, which hides most of the network latency.
+
+    Pass the tape_session for plain Record objects. Leave it out for objects
+    that know their session themselves, like turbotape.cache.CachedItem.
+    """
+    def save(record):
+        if tape_session is None:
+            return record.save()
+        return record.save(tape_session)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # list() re-raises the first error that happened while saving.
+        list(executor.map(save, records))
@@ -3,13 +3,29 @@ import logging
 import os
 from collections.abc import Mapping
 from decimal import Decimal
+from functools import lru_cache
 from typing import Union
 
-import dateutil.parser
-
 
 log = logging.getLogger(__name__)
 
+TAPE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+@lru_cache(maxsize=4096)
+def parse_tape_datetime(date_str: str) -> datetime.datetime:
+    """
+    Parse a date as Tape sends it ('2018-07-27 01:00:00'). strptime() is slow
+    and records often share the same dates, so the results are cached.
+    """
+    return datetime.datetime.strptime(date_str, TAPE_DATETIME_FORMAT)
+
+
+def _first_value(field):
+    """Return the first entry of a field's values or None if there is none."""
+    values = field.get('values')
+    return values[0] if values else None
+
 
 class FieldMediator(object):
     """
@@ -46,8 +62,8 @@ class EmbedMediator(FieldMediator):
     """
     def fetch(self, field, field_param=None):
         if field_param is None:
-            for value in field.get('values', []):
-                return value['embed']['url']
+            value = _first_value(field)
+            return value['embed']['url'] if value is not None else None
         elif field_param == 'all':
             return [v['embed']['url'] for v in field.get('values', [])]
         return None
@@ -118,10 +134,10 @@ class ContactMediator(FieldMediator):
         "name": "John Doe"
       }
     """
-    def fetch(field, field_param=None):
+    def fetch(self, field, field_param=None):
         if field_param is None:
-            for value in field.get('values', []):
-                return value['value']
+            value = _first_value(field)
+            return value['value'] if value is not None else None
         elif field_param == 'all':
             return [v['value'] for v in field.get('values', [])]
         return None
@@ -134,18 +150,34 @@ class AppMediator(FieldMediator):
     app:
       value: The id of the app item
     """
-    def fetch(self, field, field_param=None):
+    def _fetch_values(self, field):
         # We return the full list of values that Podio provides
-        if field_param == 'values':
-            return [v['value'] for v in field.get('values', [])]
+        return [v['value'] for v in field.get('values', [])]
+
+    def _fetch_items(self, field):
         # Default case: Return just the item_id(s)
-        items = [v['value']['item_id'] for v in field.get('values', [])]
-        if not field_param:
-            return items
-        if field_param == 'first':
-            return items[0]
-        elif field_param == 'last':
-            return items[:-1]
+        return [v['value']['item_id'] for v in field.get('values', [])]
+
+    def _fetch_first(self, field):
+        return self._fetch_items(field)[0]
+
+    def _fetch_last(self, field):
+        return self._fetch_items(field)[:-1]
+
+    def _fetch_nothing(self, field):
+        return None
+
+    # {field_param: handler}
+    _FETCH = {
+        'values': _fetch_values,
+        None: _fetch_items,
+        '': _fetch_items,
+        'first': _fetch_first,
+        'last': _fetch_last,
+    }
+
+    def fetch(self, field, field_param=None):
+        return self._FETCH.get(field_param, AppMediator._fetch_nothing)(self, field)
 
     def update(self, field, value, field_param=None):
         item_id_list = value
@@ -183,43 +215,66 @@ class DateMediator(FieldMediator):
     """
     def update(self, field, value, field_param=None):
         if isinstance(value, datetime.datetime):
-            start = value.strftime('%Y-%m-%d %H:%M:%S')
+            start = value.strftime(TAPE_DATETIME_FORMAT)
         if isinstance(value, str):
-            start = dateutil.parser.parse(value).strftime('%Y-%m-%d %H:%M:%S')
+            # Try Tape's own format and ISO 8601 first, dateutil is much slower
+            # and only imported when it is really needed.
+            try:
+                parsed = parse_tape_datetime(value)
+            except ValueError:
+                try:
+                    parsed = datetime.datetime.fromisoformat(value)
+                except ValueError:
+                    import dateutil.parser
+                    parsed = dateutil.parser.parse(value)
+            start = parsed.strftime(TAPE_DATETIME_FORMAT)
 
         return [{
             'start': start
         }]
 
 
-    def fetch(self, field, field_param=None):
-        if field_param is None:
-            for value in field.get('values', []):
-                return value['start']
-        if field_param == 'start':
-            for value in field.get('values', []):
-                return value['start']
-        if field_param in ['start_datetime', 'startdatetime', 'start_dt', 'startdt']:
-            for value in field.get('values', []):
-                date_str = value['start']
-                return datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-        if field_param == 'end':
-            for value in field.get('values', []):
-                return value['end']
-        if field_param in ['end_datetime', 'enddatetime', 'end_dt', 'enddt']:
-            for value in field.get('values', []):
-                date_str = value['end']
-                return datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-        if field_param == 'datetime':
-            for value in field.get('values', []):
-                date_str = value['start']
-                return datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+    def _fetch_start(self, field):
+        value = _first_value(field)
+        return value['start'] if value is not None else None
+
+    def _fetch_start_datetime(self, field):
+        value = _first_value(field)
+        return parse_tape_datetime(value['start']) if value is not None else None
+
+    def _fetch_end(self, field):
+        value = _first_value(field)
+        return value['end'] if value is not None else None
 
+    def _fetch_end_datetime(self, field):
+        value = _first_value(field)
+        return parse_tape_datetime(value['end']) if value is not None else None
+
+    def _fetch_nothing(self, field):
         return None
 
+    # {field_param: handler}, aliases point to the same handler.
+    _FETCH = {
+        None: _fetch_start,
+        'start': _fetch_start,
+        'start_datetime': _fetch_start_datetime,
+        'startdatetime': _fetch_start_datetime,
+        'start_dt': _fetch_start_datetime,
+        'startdt': _fetch_start_datetime,
+        'datetime': _fetch_start_datetime,
+        'end': _fetch_end,
+        'end_datetime': _fetch_end_datetime,
+        'enddatetime': _fetch_end_datetime,
+        'end_dt': _fetch_end_datetime,
+        'enddt': _fetch_end_datetime,
+    }
+
+    def fetch(self, field, field_param=None):
+        return self._FETCH.get(field_param, DateMediator._fetch_nothing)(self, field)
+
     def as_podio_dict(self, field):
-        for value in field.get('values', []):
-            return {'start': value['start']}
+        value = _first_value(field)
+        return {'start': value['start']} if value is not None else None
 
 
 class ImageMediator(FieldMediator):
@@ -252,14 +307,32 @@ class ImageMediator(FieldMediator):
         external_id: "images"
     """
     def update(self, field, value, field_param=None):
-        for id in value:
-            pass
-    
+        file_ids = [value] if isinstance(value, (int, str)) else value
+        return [{'value': {'file_id': file_id}} for file_id in file_ids]
+
     def fetch(self, field, field_param=None):
         return [ val['value']['file_id'] for val in field.get('values', []) ]
         
     def as_podio_dict(self, field):
-        pass
+        return self.fetch(field)
+
+
+# Decimal() is slow to construct and number fields often repeat the same few
+# values, so the conversions below are cached.
+@lru_cache(maxsize=2048)
+def _format_number(value) -> str:
+    """Format a number (or its string form) the way Tape stores it: '1.0000'."""
+    return f'{Decimal(value):.4f}'
+
+
+@lru_cache(maxsize=2048)
+def _number_to_int(value) -> int:
+    return int(Decimal(value).to_integral())
+
+
+@lru_cache(maxsize=2048)
+def _number_to_float(value) -> float:
+    return float(Decimal(value))
 
 
 class NumberMediator(FieldMediator):
@@ -274,25 +347,36 @@ class NumberMediator(FieldMediator):
         ],
     """
     def update(self, field, value, field_param=None):
-        dvalue = Decimal(value)
         values = [{
-            'value': f'{dvalue:.4f}'
+            'value': _format_number(value)
         }]
         return values
 
-    def fetch(self, field, field_param=None):
-        if field_param is None:
-            for value in field.get('values', []):
-                dvalue = Decimal(value['value'])
-                return f'{dvalue:.4f}'
-        if field_param == 'int':
-            for value in field.get('values', []):
-                return int(Decimal(value['value']).to_integral())
-        if field_param == 'float':
-            for value in field.get('values', []):
-                return float(Decimal(value['value']))
+    def _fetch_str(self, field):
+        value = _first_value(field)
+        return _format_number(value['value']) if value is not None else None
+
+    def _fetch_int(self, field):
+        value = _first_value(field)
+        return _number_to_int(value['value']) if value is not None else None
+
+    def _fetch_float(self, field):
+        value = _first_value(field)
+        return _number_to_float(value['value']) if value is not None else None
+
+    def _fetch_nothing(self, field):
         return None
 
+    # {field_param: handler}
+    _FETCH = {
+        None: _fetch_str,
+        'int': _fetch_int,
+        'float': _fetch_float,
+    }
+
+    def fetch(self, field, field_param=None):
+        return self._FETCH.get(field_param, NumberMediator._fetch_nothing)(self, field)
+
     def as_podio_dict(self, field):
         return self.fetch(field)
 
@@ -314,24 +398,16 @@ class TextMediator(FieldMediator):
 
     def fetch(self, field, field_param=None):
         if field_param == 'unformatted':
-            values = field.get('values')
-            if values:
-                for value in values:
-                    return value['unformatted_value']
+            value = _first_value(field)
+            return value['unformatted_value'] if value is not None else None
         elif field_param is None:
-            values = field.get('values')
-            if values:
-                for value in values:
-                    return value['value']
+            value = _first_value(field)
+            return value['value'] if value is not None else None
         return None
 
     def as_podio_dict(self, field):
-        values = field.get('values')
-        if values and len(values) > 0:
-            for value in values:
-                return value['value']
-        else:
-            return []
+        value = _first_value(field)
+        return value['value'] if value is not None else []
 
 
 class CategoryMediator(FieldMediator):
@@ -352,59 +428,91 @@ class CategoryMediator(FieldMediator):
     """
     def update(self, field, value: Union[str, int, list], field_param=None):
         opts = field['config']['settings']['options']
-        selected_opts = []
-        
+        # Look the options up by text and by id instead of scanning all options
+        # for every selected value.
+        opts_by_text = {}
+        opts_by_id = {}
+        for opt in opts:
+            opts_by_text.setdefault(opt['text'], opt)
+            opts_by_id.setdefault(opt['id'], opt)
+
         # single values
         if isinstance(value, str) or isinstance(value, int):
             selected_values = [value]
-            
+        else:
+            selected_values = value
+
+        selected_opts = []
         for val in selected_values:
-            for opt in opts:
-                if isinstance(val, str) and opt['text'] == val:
-                    selected_opts.append(opt)
-                if isinstance(val, int) and opt['id'] == value:
-                    selected_opts.append(opt)
+            if isinstance(val, str):
+                opt = opts_by_text.get(val)
+            elif isinstance(val, int):
+                opt = opts_by_id.get(val)
+            else:
+                opt = None
+            if opt is not None:
+                selected_opts.append(opt)
 
         # Category field values are wrapped in a dictionary with a single key
         # named 'value' (see docstring of this class) – heaven only knows why.
         return [{'value': opt} for opt in selected_opts]
         
-    def fetch(self, field, field_param=None):
-        if field_param == 'choices':
-            options = field['config']['settings']['options']
-            return [(opt['id'], opt['text']) for opt in options]
+    def _fetch_choices(self, field):
+        options = field['config']['settings']['options']
+        return [(opt['id'], opt['text']) for opt in options]
+
+    def _fetch_choices_dict(self, field):
         # The same as '__choices' but instead of a list of tuples it returns a dictionary
         # that contains the choices and choice ID numbers.
-        elif field_param == 'choices_dict':
-            options = field['config']['settings']['options']
-            return {opt['text']: opt['id'] for opt in options}
-        elif field_param == 'active':
-            val = field.get('values', [None])[0]
-            if val is not None:
-                try:
-                    return val['value']
-                except KeyError:
-                    return None
-            else:
-                return None
-        elif field_param == 'all':
-            values = []
-            for v in field.get('values', []):
-                values.append(v.get('value'))
-            return values
-        elif field_param == 'labels':
-            values = []
-            for v in field.get('values', []):
-                podval = v.get('value')
-                if podval is not None:
-                    values.append(podval['text'])
-            return values
-        elif field_param is None:
-            val = field.get('values', [None])[0]
-            if val is not None:
-                return val['value']['text']
-            else:
+        options = field['config']['settings']['options']
+        return {opt['text']: opt['id'] for opt in options}
+
+    def _fetch_active(self, field):
+        val = field.get('values', [None])[0]
+        if val is not None:
+            try:
+                return val['value']
+            except KeyError:
                 return None
+        else:
+            return None
+
+    def _fetch_all(self, field):
+        values = []
+        for v in field.get('values', []):
+            values.append(v.get('value'))
+        return values
+
+    def _fetch_labels(self, field):
+        values = []
+        for v in field.get('values', []):
+            podval = v.get('value')
+            if podval is not None:
+                values.append(podval['text'])
+        return values
+
+    def _fetch_text(self, field):
+        val = field.get('values', [None])[0]
+        if val is not None:
+            return val['value']['text']
+        else:
+            return None
+
+    def _fetch_nothing(self, field):
+        return None
+
+    # {field_param: handler}
+    _FETCH = {
+        'choices': _fetch_choices,
+        'choices_dict': _fetch_choices_dict,
+        'active': _fetch_active,
+        'all': _fetch_all,
+        'labels': _fetch_labels,
+        None: _fetch_text,
+    }
+
+    def fetch(self, field, field_param=None):
+        return self._FETCH.get(field_param, CategoryMediator._fetch_nothing)(self, field)
                 
     def as_podio_dict(self, field):
         return [v['value']['id'] for v in field.get('values', [])]
@@ -417,28 +525,45 @@ class EmailMediator(FieldMediator):
         type: "home"/"work"/ "other"
     """
 
+    def _fetch_all(self, field, field_param):
+        vals = field.get('values', [])
+        return vals
+
+    def _fetch_type(self, field, field_param):
+        vals = field.get('values', None)
+        if vals is None:
+            return None
+        for val in vals:
+            if val.get('type') == field_param:
+                return val.get('value')
+        return None
+
+    def _fetch_first(self, field, field_param):
+        val = field.get('values', [None])[0]
+        if val is not None:
+            return val.get('value')
+        else:
+            return None
+
+    def _fetch_nothing(self, field, field_param):
+        return None
+
+    # {field_param: handler}
+    _FETCH = {
+        'all': _fetch_all,
+        'work': _fetch_type,
+        'home': _fetch_type,
+        'other': _fetch_type,
+        None: _fetch_first,
+    }
+
     def fetch(self, field, field_param=None):
         """
         email: only the first value is returned
         email__all: [{"type": "work", "value": "xyz@example.com"}]
         email__work/home/other: The first value of the particular type is returned.
         """
-        if field_param == 'all':
-            vals = field.get('values', [])
-            return vals
-        elif field_param in ['work', 'home', 'other']:
-            vals = field.get('values', None)
-            if vals is None:
-                return None
-            for val in vals:
-                if val.get('type') == field_param:
-                    return val.get('value')
-        elif field_param is None:
-            val = field.get('values', [None])[0]
-            if val is not None:
-                return val.get('value')
-            else:
-                return None
+        return self._FETCH.get(field_param, EmailMediator._fetch_nothing)(self, field, field_param)
 
 # phone:
 #   type: "mobile"/"work"/"home"/"main"/"work_fax"/"private_fax"/ "other"
@@ -448,63 +573,86 @@ class EmailMediator(FieldMediator):
 class CalculationMediator(FieldMediator):
     def fetch(self, field, field_param=None):
         # Dates are special
+        value = _first_value(field)
+        if value is None:
+            return None
         if field['config']['settings'].get('return_type') == 'date':
-            for value in field.get('values', []):
-                dt = datetime.datetime.strptime(value['start'], '%Y-%m-%d %H:%M:%S')
-                if field_param == 'datetime':
-                    return dt
-                else:
-                    return '{}'.format(dt)
-        for value in field.get('values', []):
-            return value['value']
-
-        print(field.get('values'))
+            dt = parse_tape_datetime(value['start'])
+            if field_param == 'datetime':
+                return dt
+            else:
+                return '{}'.format(dt)
+        return value['value']
 
+# Mediators keep no state, so one shared instance per field type is enough.
 MEDIATORS = {
-    'app': AppMediator,
-    'calculation': CalculationMediator,
-    'category': CategoryMediator,
-    'contact': ContactMediator,
-    'date': DateMediator,
-    'email': EmailMediator,
-    'embed': EmbedMediator,
-    'number': NumberMediator,
-    'text': TextMediator,
-    'image': ImageMediator,
+    'app': AppMediator(),
+    'calculation': CalculationMediator(),
+    'category': CategoryMediator(),
+    'contact': ContactMediator(),
+    'date': DateMediator(),
+    'email': EmailMediator(),
+    'embed': EmbedMediator(),
+    'number': NumberMediator(),
+    'text': TextMediator(),
+    'image': ImageMediator(),
     # ... add future mediators here
 }
 
 
+@lru_cache(maxsize=1024)
 def split_descriptor_parts(field_descriptor):
     """
+    Split a descriptor like 'date__end' into ('date', 'end'). Code usually reads
+    the same few descriptors over and over, so the results are cached.
+
     :param field_descriptor:
-    :return:
+    :return: (external_id, field_param), field_param is None if there is none.
     """
-    descriptor_parts = field_descriptor.split('__', 1)
-    if len(descriptor_parts) == 2:
-        external_id = descriptor_parts[0]
-        field_param = descriptor_parts[1]
-    else:
-        external_id = descriptor_parts[0]
+    external_id, separator, field_param = field_descriptor.partition('__')
+    if not separator:
         field_param = None
     return external_id, field_param
 
 
-def get_field_from_podio_json_list(item_json, external_id, app_config=None):
+def build_field_index(fields: list) -> dict:
+    """
+    Return a {external_id: field} dictionary for a list of fields. Like the
+    linear search it replaces, the first field with an external_id wins.
+    """
+    field_index = {}
+    for field in fields:
+        field_index.setdefault(field['external_id'], field)
+    return field_index
+
+
+def get_field_from_podio_json_list(item_json, external_id, app_config=None,
+                                   field_index=None, app_field_index=None):
     """
     :param external_id:
+    :param field_index: Optional result of build_field_index() for the item's
+        fields, used instead of searching the list.
+    :param app_field_index: The same for the fields of the app_config.
     :return:
     """
-    fields = item_json.get('fields', [])
-
-    for field in fields:
-        if field['external_id'] == external_id:
+    if field_index is not None:
+        field = field_index.get(external_id)
+        if field is not None:
             return field
+    else:
+        for field in item_json.get('fields', []):
+            if field['external_id'] == external_id:
+                return field
 
     if app_config:
-        for field in app_config['fields']:
-            if field['external_id'] == external_id:
+        if app_field_index is not None:
+            field = app_field_index.get(external_id)
+            if field is not None:
                 return field
+        else:
+            for field in app_config['fields']:
+                if field['external_id'] == external_id:
+                    return field
         # Only raise the KeyError if we have the app_config and can know for certain
         # that the field does not exist.
         raise KeyError('%s' % external_id)
@@ -514,32 +662,42 @@ def get_field_from_podio_json_list(item_json, external_id, app_config=None):
     return None
 
 
-def find_mediator_class(field):
+def find_mediator(field):
     field_type = field['type']
-    # try to find the correct FieldMediator class
-    mediator_class = MEDIATORS.get(field_type)
-    if not mediator_class:
+    # try to find the correct FieldMediator
+    mediator = MEDIATORS.get(field_type)
+    if not mediator:
         raise NotImplementedError('Field type "%s" is not supported, yet.' % field_type)
-    return mediator_class
+    return mediator
+
+
+def find_mediator_class(field):
+    """Kept for backwards compatibility, use find_mediator() instead."""
+    return type(find_mediator(field))
 
 
-def fetch_field(field_descriptor, item_json, app_config=None):
+def fetch_field(field_descriptor, item_json, app_config=None, field_index=None,
+                app_field_index=None):
     """
     Fetch the first value of a field - or None if the field is empty.
     :param field_descriptor: The Podio external_id name as shown in the developer view.
-    :param item_json: The JSON representation of the Podio item.
+    :param item_json: The JSON representation of the Podio item. A Record works
+        as well and then uses its field index instead of searching the fields.
     :return: First value or None
     """
+    if isinstance(item_json, BaseRecord):
+        return item_json[field_descriptor]
+
     external_id, field_param = split_descriptor_parts(field_descriptor)
 
     # Get the only the JSON part of the desired field
-    field = get_field_from_podio_json_list(item_json, external_id, app_config)
+    field = get_field_from_podio_json_list(item_json, external_id, app_config,
+                                           field_index, app_field_index)
     if not field:
         return None
 
-    # Find and instanciate the correct FieldMediator for this kind of field.
-    mediator_class = find_mediator_class(field)
-    mediator = mediator_class()
+    # Find the correct FieldMediator for this kind of field.
+    mediator = find_mediator(field)
 
     # Use the mediator to get the actual data
     return mediator.fetch(field, field_param)
@@ -551,9 +709,8 @@ def update_field(field_descriptor, new_value, item_json, app_config=None):
     # Get the only the JSON part of the desired field
     field = get_field_from_podio_json_list(item_json, external_id, app_config)
 
-    # Find and instanciate the correct FieldMediator for this kind of field.
-    mediator_class = find_mediator_class(field)
-    mediator = mediator_class()
+    # Find the correct FieldMediator for this kind of field.
+    mediator = find_mediator(field)
 
     # Use the mediator to get the actual data
     actual = mediator.update(field, new_value, field_param)
@@ -573,7 +730,8 @@ def update_field(field_descriptor, new_value, item_json, app_config=None):
     return actual
 
 
-def fetch_podio_dict(field_descriptor, item_json, app_config=None):
+def fetch_podio_dict(field_descriptor, item_json, app_config=None, field_index=None,
+                     app_field_index=None):
     """
     Fetch the first value of a field - or None if the field is empty.
     :param field_descriptor: The field's external_id as shown in the developer view.
@@ -583,13 +741,13 @@ def fetch_podio_dict(field_descriptor, item_json, app_config=None):
     external_id, field_param = split_descriptor_parts(field_descriptor)
 
     # Get the only the JSON part of the desired field
-    field = get_field_from_podio_json_list(item_json, external_id, app_config)
+    field = get_field_from_podio_json_list(item_json, external_id, app_config,
+                                           field_index, app_field_index)
     if not field:
         return None
 
-    # Find and instanciate the correct FieldMediator for this kind of field.
-    mediator_class = find_mediator_class(field)
-    mediator = mediator_class()
+    # Find the correct FieldMediator for this kind of field.
+    mediator = find_mediator(field)
 
     # Use the mediator to get the actual data
     return mediator.as_podio_dict(field)
@@ -619,18 +777,40 @@ def fetch_all_files(record_json):
 
 
 class BaseRecord(Mapping):
+    # Apps are often loaded completely into memory, __slots__ keeps the many
+    # record objects small.
+    __slots__ = ('_app_config', '_tainted', '_field_index', '_field_index_source',
+                 '_field_index_length', '_app_field_index', '_app_field_index_source',
+                 '_unique_id')
+
     def __getitem__(self, key):
-        return fetch_field(key, self.get_item_data(), self.get_app_config())
+        # Fast path for the common case: the field is part of the item and of
+        # a known type. Everything else (empty fields, app_config fallback,
+        # errors) goes through fetch_field().
+        external_id, field_param = split_descriptor_parts(key)
+        field = self.get_field_index().get(external_id)
+        if field is not None:
+            mediator = MEDIATORS.get(field['type'])
+            if mediator is not None:
+                return mediator.fetch(field, field_param)
+        app_config = self.get_app_config()
+        return fetch_field(key, self.get_item_data(), app_config,
+                           self.get_field_index(), self.get_app_field_index(app_config))
 
     def __setitem__(self, key, value):
         update_field(key, value, self.get_item_data(), self.get_app_config())
         self._tainted.add(key)
 
     def __iter__(self):
-        return iter(self.get_item_data()['fields'])
+        # Like any Mapping, iterate over the keys, i.e. the external_ids.
+        return iter(self.get_field_index())
 
     def __len__(self):
-        return len(self.get_item_data()['fields'])
+        return len(self.get_field_index())
+
+    def __contains__(self, key):
+        external_id, _ = split_descriptor_parts(key)
+        return external_id in self.get_field_index()
 
     def get_item_data(self) -> list:
         raise NotImplementedError()
@@ -638,6 +818,31 @@ class BaseRecord(Mapping):
     def get_app_config(self):
         return self._app_config
 
+    def get_field_index(self) -> dict:
+        """
+        Return a {external_id: field} dictionary of the record's fields. It is
+        rebuilt whenever a field is added or the list of fields is replaced.
+        """
+        fields = self.get_item_data().get('fields', [])
+        if getattr(self, '_field_index_source', None) is not fields \
+                or self._field_index_length != len(fields):
+            self._field_index = build_field_index(fields)
+            self._field_index_source = fields
+            self._field_index_length = len(fields)
+        return self._field_index
+
+    def get_app_field_index(self, app_config=None):
+        """
+        Return a {external_id: field} dictionary of the app_config's fields or
+        None if there is no app_config.
+        """
+        if not app_config:
+            return None
+        if getattr(self, '_app_field_index_source', None) is not app_config:
+            self._app_field_index = build_field_index(app_config['fields'])
+            self._app_field_index_source = app_config
+        return self._app_field_index
+
     @property
     def app_id(self):
         return self.get_item_data()['app']['app_id']
@@ -667,7 +872,13 @@ class BaseRecord(Mapping):
 
     @property
     def unique_id(self):
-        return int(self.get_item_data()['link'].rsplit('/', 1)[1])
+        # The link of a record never changes, so parse it only once. (No
+        # functools.cached_property here, it does not work with __slots__.)
+        try:
+            return self._unique_id
+        except AttributeError:
+            self._unique_id = int(self.get_item_data()['link'].rsplit('/', 1)[1])
+            return self._unique_id
 
     @property
     def unique_id__str(self):
@@ -699,32 +910,36 @@ class BaseRecord(Mapping):
         """
         podio_dict = {}
         app_config = self.get_app_config()
+        item_data = self.get_item_data()
+        field_index = self.get_field_index()
+        app_field_index = self.get_app_field_index(app_config)
         if not app_config:
-            app_fields = self.get_item_data().get('fields', [])
+            app_fields = item_data.get('fields', [])
         else:
             app_fields = app_config.get('fields', [])
+        if fields is not None:
+            # Only visit the requested fields (e.g. the changed ones in save())
+            # instead of scanning every field of the app.
+            known_fields = app_field_index if app_config else field_index
+            app_fields = [known_fields[external_id] for external_id in fields
+                          if external_id in known_fields]
         for field in app_fields:
             # Ignore calculation fields.
             if field.get('type') == 'calculation':
                 continue
 
+            # The field list already gives us the external_ids, so skip the
+            # descriptor parsing of fetch_podio_dict() and use the item's own
+            # field (which holds the values) directly.
             external_id = field['external_id']
-
-            # do not add fields to the dict that are not in the fields list.
-            if fields != None and external_id not in fields:
-                continue
-
-            field_podio_dict = \
-                fetch_podio_dict(external_id, self.get_item_data(), self.get_app_config())
-            podio_dict = dict(
-                podio_dict,
-                **{external_id: field_podio_dict}
-            )
+            field = field_index.get(external_id, field)
+            podio_dict[external_id] = find_mediator(field).as_podio_dict(field)
 
         return podio_dict
 
 
 class Record(BaseRecord):
+    __slots__ = ('item_data',)
 
     def __init__(self, item_data: dict, app_config=None):
         self._tainted = set()
@@ -737,7 +952,7 @@ class Record(BaseRecord):
     def save(self, podio_session=None) -> None:
         if not podio_session:
             raise Exception("You need to supply a podio session")
-        tainted_fields = list(self._tainted)
+        tainted_fields = frozenset(self._tainted)
         podio_dict = self.as_podio_dict(fields=tainted_fields)
         resp = podio_session.put(
             f'https://api.podio.com/item/{self.item_id}/value',
@@ -1,42 +1,202 @@
 import os
 import logging
+import math
+import random
+import uuid
+from functools import lru_cache
 from pathlib import Path
 from typing import Union
 from time import sleep
 import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
 
-log = logging.getLogger(__file__)
+from turbotape.helpers import json_dumps, json_loads
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+try:
+    import httpx  # type: ignore
+except ImportError:
+    httpx = None
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait before the first retry, every further retry waits twice as long.
+RETRY_BACKOFF = 3.0
+RETRY_BACKOFF_MAX = 60.0
+
+# Connections kept open per host. This must be at least the concurrency of the
+# helpers that send requests in parallel (downloads, uploads, bulk saves),
+# otherwise extra connections are opened and thrown away again.
+HTTP_POOL_SIZE = 32
+
+
+def retry_wait_seconds(retries_done: int) -> float:
+    """
+    Exponential backoff: 3, 6, 12, 24 ... seconds, but never more than a minute.
+    """
+    return min(RETRY_BACKOFF * (2 ** retries_done), RETRY_BACKOFF_MAX)
+
+
+def jittered_wait_seconds(retries_done: int) -> float:
+    """
+    Like retry_wait_seconds() but randomly shortened by up to half, so that
+    many workers failing at the same moment don't all retry at the same moment.
+    """
+    seconds = retry_wait_seconds(retries_done)
+    return random.uniform(seconds / 2, seconds)
+
+
+@lru_cache(maxsize=32)
+def parse_retry_reset(reset_time_raw: str) -> datetime.datetime:
+    """
+    Parse the `X-Retry-Reset` header ('2024-01-31 12:00:00', UTC) into a
+    time-zone aware datetime. Workers hitting the limit together see the same value.
+    """
+    if reset_time_raw.endswith('Z'):
+        reset_time_raw = reset_time_raw[:-1]
+    reset_time = datetime.datetime.fromisoformat(reset_time_raw)
+    if reset_time.tzinfo is None:
+        reset_time = reset_time.replace(tzinfo=datetime.timezone.utc)
+    return reset_time
+
+
+def rate_limit_wait_seconds(response, retries_done: int) -> float:
+    """
+    How long to wait after a 429 response. Tape sends the time of the reset in
+    `X-Retry-Reset`, other servers may send `Retry-After` in seconds.
+    """
+    reset_time_raw = response.headers.get('X-Retry-Reset')
+    if reset_time_raw:
+        tz_reset_time = parse_retry_reset(reset_time_raw)
+        # Use max() to avoid negative wait times.
+        seconds = max((tz_reset_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 1.0)
+        return seconds + 1.0
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(float(retry_after), 1.0)
+        except ValueError:
+            pass
+    return retry_wait_seconds(retries_done)
+
+
+def _plain_json(obj) -> bool:
+    """
+    Return False if obj holds values that json_dumps() would write although
+    requests refuses to: NaN, Infinity and (with orjson) UUIDs.
+    """
+    if isinstance(obj, float):
+        return math.isfinite(obj)
+    if isinstance(obj, dict):
+        return all(_plain_json(key) and _plain_json(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return all(_plain_json(value) for value in obj)
+    return not isinstance(obj, uuid.UUID)
+
+
+def _not_json_serializable(obj):
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+# orjson hands everything json can't serialize either to the default function,
+# which rejects it like json does.
+JSON_BODY_OPTIONS = 0 if orjson is None else (
+    orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS |
+    orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_NON_STR_KEYS)
+
+
+def _json_body(obj) -> Union[bytes, None]:
+    """
+    Serialize the json= argument of a request with orjson if installed.
+    Returns None if requests should serialize it as before, because it
+    would reject the object or write it differently.
+    """
+    if not _plain_json(obj):
+        return None
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, default=_not_json_serializable, option=JSON_BODY_OPTIONS)
+        return json_dumps(obj).encode('utf-8')
+    except TypeError:
+        return None
+
+
+class TapeResponse(requests.Response):
+    """A Response whose json() parses with json_loads() (orjson if installed)."""
+
+    def json(self, **kwargs):
+        # Options for json.loads() are only understood by the original method.
+        if kwargs:
+            return super().json(**kwargs)
+        return json_loads(self.content)
 
 
 class TapeSession(requests.Session):
+    # request() accepts a function that builds the body as data, see below.
+    accepts_body_factory = True
+
     def __init__(self, tape_api_key, robust=True):
         super().__init__()
         self.headers.update({
             'authorization': f'Bearer {tape_api_key}',
         })
+        # Keep enough connections around for requests running in parallel.
+        # Retries stay in request() below because they depend on Tape's
+        # X-Retry-Reset header, so the adapter itself does not retry.
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
         self.enable_robustness = robust is True
 
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # Let response.json() parse with json_loads() (orjson if installed).
+        response.__class__ = TapeResponse
+        return response
+
     def request(self, method, url, data=None, headers=None, **kwargs):
+        # Serialize JSON bodies with json_dumps() (orjson if installed) instead
+        # of the json module that requests would use.
+        json_body = kwargs.get('json')
+        if json_body is not None and data is None:
+            data = _json_body(json_body)
+            if data is not None:
+                del kwargs['json']
+                headers = dict(headers or {})
+                if not any(key.lower() == 'content-type' for key in headers):
+                    headers['Content-Type'] = 'application/json'
+
+        # data may also be a function that returns the body. It is called for
+        # every attempt, so that retries can send bodies that are used up by
+        # sending them once, e.g. streamed uploads.
+        make_data = data if callable(data) else None
+
         # the usual way of doing requests
         if not self.enable_robustness:
             return super().request(
                 method, 
                 url,
-                data=data,
+                data=make_data() if make_data else data,
                 headers=headers, 
                 **kwargs
             )
 
         # robust way that tries to deal with most of the occuring errors
-        # (e.g. 502 Bad Gateway). The request is retried five times.
-        retry_counter = 5
+        # (e.g. 502 Bad Gateway). The request is retried five times with
+        # exponential backoff.
+        max_retries = 5
+        retry_counter = max_retries
         while True:
             try:
                 response = super().request(
                     method, url,
-                    data=data,
+                    data=make_data() if make_data else data,
                     headers=headers,
                     **kwargs)
             except requests.exceptions.ConnectionError as err:
@@ -46,7 +206,7 @@ class TapeSession(requests.Session):
                 if retry_counter < 1:
                     raise err
                 else:
-                    sleep(3.0)
+                    sleep(jittered_wait_seconds(max_retries - retry_counter - 1))
                     continue
 
             # all retries have been used up. Return the response regardless of the status code.
@@ -60,22 +220,17 @@ class TapeSession(requests.Session):
             if 429 == response.status_code:
                 # Rate-limit exceeded
                 retry_counter -= 1
-                reset_time_raw = response.headers['X-Retry-Reset']
-                reset_time = datetime.datetime.strptime(reset_time_raw, "%Y-%m-%d %H:%M:%S")
-                # Create a time-zone aware version of the `X-Retry-Reset` time.
-                tz_reset_time = reset_time.replace(tzinfo=datetime.timezone.utc)
-                # Use max() to avoid negative wait times.
-                seconds = max((tz_reset_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 1.0)
-                log.warning(f"HTTP 429 Client Error: Too Many Requests, waiting till {reset_time} ({seconds + 1.0} s)")
-                sleep(seconds + 1.0)
+                seconds = rate_limit_wait_seconds(response, max_retries - retry_counter - 1)
+                log.warning(f"HTTP 429 Client Error: Too Many Requests, waiting {seconds} s")
+                sleep(seconds)
                 continue
 
             if 400 <= response.status_code < 500:
                 log.error("HTTP Error happened, status: %s" % response.status_code)
                 log.error('* method: %s' % method)
                 log.error('* url: %s' % url)
-                if kwargs.get('json'):
-                    log.error('* json: %s' % repr(kwargs['json']))
+                if json_body:
+                    log.error('* json: %s' % repr(json_body))
                 log.error('* server response: %s' % repr(response.content))
                 sleep(3.0)
                 # Errors like 404 or 403 are most likely our own fault and we return immediately
@@ -84,19 +239,74 @@ class TapeSession(requests.Session):
             if 500 <= response.status_code < 600:
                 # Most likely, we have encountered a 502 Bad gateway or 504 Gateway timeout error.
                 retry_counter -= 1
-                log.warning('Response from URL "%s" with status code %d. Retrying in 3 seconds ...' % (url, response.status_code))
-                sleep(3.0)
+                seconds = jittered_wait_seconds(max_retries - retry_counter - 1)
+                log.warning('Response from URL "%s" with status code %d. Retrying in %s seconds ...' % (url, response.status_code, seconds))
+                sleep(seconds)
                 continue
 
 
-def make_tape_client(token: str, check=True, robust: bool=True) -> TapeSession:
+@lru_cache(maxsize=4)
+def _shared_tape_client(token: str, robust: bool) -> TapeSession:
+    return TapeSession(tape_api_key=token, robust=robust)
+
+
+def make_tape_client(token: str, check=True, robust: bool=True, shared: bool=False) -> TapeSession:
+    """
+    Create a TapeSession. With shared=True, calls with the same token get the
+    same session back, so they share its pool of open connections instead of
+    each paying for new TCP and TLS handshakes. Don't change the headers or
+    other settings of a shared session.
+    """
+    if token is None or token == "":
+        raise Exception("Tape API key not given or key is empty.")
+    if shared:
+        return _shared_tape_client(token, robust is True)
+    return TapeSession(tape_api_key=token, robust=robust)
+
+
+def make_http2_client(token: str):
+    """
+    Create an httpx client that talks HTTP/2 to the Tape API. It can be used
+    instead of a TapeSession with the helpers (e.g. iterate_resource): the
+    concurrent page requests are then multiplexed over a single connection
+    instead of opening one connection per request.
+
+    Requires `pip install httpx[http2]`. Unlike TapeSession, the client does not
+    retry failed requests.
+    """
+    if httpx is None:
+        raise ImportError("The module httpx is not installed. Run 'pip install httpx[http2]' "
+                          "or equivalent to install.")
+    if token is None or token == "":
+        raise Exception("Tape API key not given or key is empty.")
+    return httpx.Client(
+        http2=True,
+        headers={'authorization': f'Bearer {token}'},
+        limits=httpx.Limits(max_keepalive_connections=1),
+    )
+
+
+def make_async_http2_client(token: str):
+    """
+    Create an httpx.AsyncClient that talks HTTP/2 to the Tape API, for code
+    that runs many requests at once with asyncio, e.g.
+
+    >>> async with create_tape_async_session() as tape:
+    ...     responses = await asyncio.gather(*(tape.get(url) for url in urls))
+
+    All requests are multiplexed over one connection. Requires
+    `pip install httpx[http2]`. Like make_http2_client(), it does not retry.
+    """
+    if httpx is None:
+        raise ImportError("The module httpx is not installed. Run 'pip install httpx[http2]' "
+                          "or equivalent to install.")
     if token is None or token == "":
         raise Exception("Tape API key not given or key is empty.")
-    session = TapeSession(tape_api_key=token, robust=robust, )
-    session.headers.update({
-        'authorization': f'Bearer {token}',
-    })
-    return session
+    return httpx.AsyncClient(
+        http2=True,
+        headers={'authorization': f'Bearer {token}'},
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    )
 
 
 def try_environment_token():
@@ -104,9 +314,8 @@ def try_environment_token():
     Try to get the token from the environment variable TAPE_API_KEY.
     :return:
     """
-    try:
-        access_token = os.environ['TAPE_API_KEY']
-    except KeyError as e:
+    access_token = os.environ.get('TAPE_API_KEY')
+    if not access_token:
         log.info('Environment variable TAPE_API_KEY is not set.')
         return None
     log.info('Loading OAuth2 token from environment.')
@@ -117,23 +326,38 @@ def load_token(creds_file: Union[Path, str]) -> str:
     """
     Load the token from the file name tape_credentials.txt (unless specified otherwise)
     """
-    token = ""
-    with open(creds_file, mode="r", encoding='utf-8') as fh:
-        token = fh.readline()
-    return token.strip()
+    # Only the first line holds the key.
+    return Path(creds_file).read_text(encoding='utf-8').partition('\n')[0].strip()
 
 
-def create_tape_session(credentials_file=None, credentials=None, check=True, robust=True):
-    token = None
+def find_token(credentials_file=None, credentials=None) -> str:
+    """
+    Return the API key given as credentials, from the environment variable
+    TAPE_API_KEY or from the credentials file (in this order).
+    """
     if credentials is not None:
-        token = credentials
-    else:
-        token = try_environment_token()
+        return credentials
+    token = try_environment_token()
     if token is None:
         log.info('Loading Tape API key from credentials file.')
-        if credentials_file is None:
-            token = load_token('tape_credentials.txt')
-        else:
-            token = load_token(credentials_file)
-    tape = make_tape_client(token, check=check, robust=robust)
+        creds_path = Path(credentials_file if credentials_file is not None else 'tape_credentials.txt')
+        if not creds_path.is_file():
+            raise FileNotFoundError(f'No Tape API key found: set TAPE_API_KEY or create {creds_path}')
+        token = load_token(creds_path)
+    return token
+
+
+def create_tape_session(credentials_file=None, credentials=None, check=True, robust=True,
+                        shared=False):
+    token = find_token(credentials_file, credentials)
+    tape = make_tape_client(token, check=check, robust=robust, shared=shared)
     return tape
+
+
+def create_tape_async_session(credentials_file=None, credentials=None):
+    """
+    Like create_tape_session() but returns an httpx.AsyncClient using HTTP/2,
+    see make_async_http2_client().
+    """
+    token = find_token(credentials_file, credentials)
+    return make_async_http2_client(token)
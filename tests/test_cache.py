@@ -1,15 +1,250 @@
+import copy
 import json
 import os
+from pathlib import Path
 from unittest import TestCase
+from unittest.mock import MagicMock
 
+from turbotape.helpers import json_dumps, json_loads
 from turbotape.cache import (
-    CachedItemStorage
+    CachedItemNotFound,
+    CachedItemStorage,
+    connect,
+    _prefetch,
+    _select_item_data_sql,
+    _insert_item_data_sql,
 )
 
 
+# Parsed once for the whole module, every test works on its own deep copy.
+TEST_RECORD = json_loads((Path(__file__).parent / 'test_record.json').read_bytes())
+
+
 class TestIterateArray(TestCase):
     def setUp(self):
         pass
 
     def test_iterate_array(self):
         pass
+
+
+class TestStatementSQL(TestCase):
+
+    def test_select_sql_is_reused(self):
+        sql1 = _select_item_data_sql(1, ('title', 'number'))
+        sql2 = _select_item_data_sql(1, ('title', 'number'))
+        self.assertIs(sql1, sql2)
+        self.assertEqual(
+            'SELECT item_data FROM podio_app_1 WHERE "title" = ? AND "number" = ?',
+            sql1
+        )
+
+    def test_select_sql_item_ids(self):
+        sql = _select_item_data_sql(1, ('title',), 3)
+        self.assertEqual(
+            'SELECT item_data FROM podio_app_1 WHERE "title" = ? AND item_id IN (?, ?, ?)',
+            sql
+        )
+
+    def test_insert_sql(self):
+        sql = _insert_item_data_sql(1, ('item_id', 'item_data'))
+        self.assertEqual(
+            'INSERT OR REPLACE INTO podio_app_1 (item_id, item_data) VALUES (?, ?)',
+            sql
+        )
+
+    def test_connect(self):
+        conn = connect(':memory:')
+        self.assertEqual(1, conn.execute('SELECT 1').fetchone()[0])
+        conn.close()
+
+
+class TestTuneConnection(TestCase):
+
+    def test_tune_connection(self):
+        conn = connect(':memory:')
+        CachedItemStorage(conn, tape_session=None)
+        self.assertEqual(1, conn.execute('PRAGMA synchronous').fetchone()[0])
+        self.assertEqual(-65536, conn.execute('PRAGMA cache_size').fetchone()[0])
+        conn.close()
+
+    def test_tune_connection_in_transaction(self):
+        conn = connect(':memory:')
+        conn.execute('CREATE TABLE t (x INT)')
+        conn.execute('INSERT INTO t VALUES (1)')
+        with self.assertLogs('turbotape.cache', level='WARNING'):
+            CachedItemStorage(conn, tape_session=None)
+        self.assertEqual(2, conn.execute('PRAGMA synchronous').fetchone()[0])
+        conn.commit()
+        self.assertEqual(1, conn.execute('SELECT x FROM t').fetchone()[0])
+        conn.close()
+
+    def test_no_tuning(self):
+        conn = connect(':memory:')
+        CachedItemStorage(conn, tape_session=None, tune=False)
+        self.assertEqual(2, conn.execute('PRAGMA synchronous').fetchone()[0])
+        conn.close()
+
+
+class TestInsertItemData(TestCase):
+
+    def setUp(self):
+        self.record = copy.deepcopy(TEST_RECORD)
+        self.record['item_id'] = self.record['record_id']
+        self.app_id = self.record['app']['app_id']
+        self.conn = connect(':memory:')
+        self.conn.execute(
+            f'CREATE TABLE podio_app_{self.app_id} (item_id INT PRIMARY KEY NOT NULL, '
+            f'item_data TEXT NULL, __natural_key TEXT NULL, "status" TEXT NULL, '
+            f'"sprint" TEXT NULL)'
+        )
+        self.storage = CachedItemStorage(self.conn, tape_session=None)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_insert_and_find(self):
+        self.storage.insert_item_data_into_db(
+            self.app_id, self.record, ['status'], ['title'], commit=True)
+        item = self.storage.get_item_by_natural_key(self.app_id, [self.record['title']])
+        self.assertEqual(self.record['record_id'], item.record_id)
+        item = self.storage.get_item_by_natural_key(self.app_id, self.record['title'])
+        self.assertEqual(self.record['record_id'], item.record_id)
+        item = self.storage.get_item_by_join_ids(self.app_id, {'status': 'In Progress'})
+        self.assertEqual(self.record['record_id'], item.record_id)
+
+    def test_related_item_column(self):
+        sprint = self.record['fields'][4]
+        sprint['values'] = [{'value': {'item_id': 4711}}]
+        self.storage.insert_item_data_into_db(
+            self.app_id, self.record, ['status', 'sprint'], ['title'], commit=True)
+        row = self.conn.execute(f'SELECT sprint FROM podio_app_{self.app_id}').fetchone()
+        self.assertEqual('4711', row[0])
+        item = self.storage.get_item_by_join_ids(self.app_id, {'sprint': 4711})
+        self.assertEqual(self.record['record_id'], item.record_id)
+        item = self.storage.get_item_by_join_ids(self.app_id, {'sprint': [4711]})
+        self.assertEqual(self.record['record_id'], item.record_id)
+
+    def test_related_item_columns_use_their_own_field(self):
+        # Regression test: the extra field value used to be read from the
+        # last natural key field instead of the extra field itself.
+        other = json.loads(json.dumps(self.record))
+        other['item_id'] = other['record_id'] = 1
+        other['fields'][0]['values'] = [{'value': 'Other record'}]
+        self.record['fields'][4]['values'] = [{'value': {'item_id': 100}}]
+        other['fields'][4]['values'] = [{'value': {'item_id': 200}}]
+        for record in [self.record, other]:
+            self.storage.insert_item_data_into_db(
+                self.app_id, record, ['sprint'], ['title'], commit=True)
+        rows = self.conn.execute(
+            f'SELECT item_id, "sprint" FROM podio_app_{self.app_id} ORDER BY item_id').fetchall()
+        self.assertEqual([(1, '200'), (self.record['item_id'], '100')], rows)
+        item = self.storage.get_item_by_join_ids(self.app_id, {'sprint': 100})
+        self.assertEqual(self.record['record_id'], item.record_id)
+        item = self.storage.get_item_by_join_ids(self.app_id, {'sprint': 200})
+        self.assertEqual(1, item.record_id)
+
+    def test_get_item_by_field_value(self):
+        self.storage.insert_item_data_into_db(
+            self.app_id, self.record, ['status'], ['title'], commit=True)
+        item = self.storage.get_item_by_field_value(
+            self.app_id, 'title', 'UI bug on login screen (Sample)')
+        self.assertEqual(self.record['record_id'], item.record_id)
+        with self.assertRaises(CachedItemNotFound):
+            # Matches the LIKE pattern but not the actual value.
+            self.storage.get_item_by_field_value(self.app_id, 'status', 'Progress')
+
+    def test_not_unique(self):
+        self.storage.insert_item_data_into_db(
+            self.app_id, self.record, ['status'], ['title'], commit=True)
+        self.storage.insert_item_data_into_db(
+            self.app_id, dict(self.record, item_id=1), ['status'], ['title'], commit=True)
+        with self.assertRaises(Exception) as ctx:
+            self.storage.get_item_by_join_ids(self.app_id, {'status': 'In Progress'})
+        self.assertIn('must be unique', str(ctx.exception))
+
+    def test_get_referenced_item(self):
+        self.storage.insert_item_data_into_db(
+            self.app_id, self.record, ['status'], ['title'], commit=True)
+        for item_ids in [[self.record['item_id']], [1, 2, self.record['item_id']]]:
+            item = self.storage.get_referenced_item(
+                self.app_id, item_ids, {'status': 'In Progress'})
+            self.assertEqual(self.record['record_id'], item.record_id)
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_referenced_item(self.app_id, [1, 2], {'status': 'In Progress'})
+
+    def test_update_item_keeps_raw_data(self):
+        self.storage.cache_configs[f'podio_app_{self.app_id}'] = {
+            'extra_fields': ['status'], 'natural_key': ['title']}
+        self.storage.insert_item_data_into_db(
+            self.app_id, self.record, ['status'], ['title'], commit=True)
+        item = self.storage.get_item(self.app_id, self.record['item_id'])
+        raw_data = item.get_raw_data()
+        self.assertIsNotNone(raw_data)
+        self.storage.update_item(item)
+        row = self.conn.execute(f'SELECT item_data FROM podio_app_{self.app_id}').fetchone()
+        self.assertEqual(raw_data, row[0])
+
+    def test_not_found(self):
+        with self.assertRaises(CachedItemNotFound):
+            self.storage.get_item_by_join_ids(self.app_id, {'status': 'Complete'})
+
+
+class TestGetAppConfig(TestCase):
+
+    def test_app_config_is_cached_for_str_app_id(self):
+        tape = MagicMock()
+        tape.get.return_value.content = b'{"app_id": 42, "fields": []}'
+        storage = CachedItemStorage(connect(':memory:'), tape)
+        self.assertEqual(42, storage.get_app_config('42')['app_id'])
+        self.assertEqual(42, storage.get_app_config('42')['app_id'])
+        self.assertEqual(42, storage.get_app_config(42)['app_id'])
+        self.assertEqual(1, tape.get.call_count)
+
+
+class TestPrefetch(TestCase):
+
+    def test_prefetch_keeps_order(self):
+        pages = [[1, 2], [3], [4, 5, 6]]
+        self.assertEqual(pages, list(_prefetch(iter(pages), maxsize=1)))
+
+    def test_prefetch_reraises(self):
+        def pages():
+            yield [1]
+            raise ValueError('bad response')
+        with self.assertRaises(ValueError):
+            list(_prefetch(pages()))
+
+
+class TestCacheApp(TestCase):
+
+    def setUp(self):
+        self.record = copy.deepcopy(TEST_RECORD)
+        self.record['item_id'] = self.record['record_id']
+        self.app_id = self.record['app']['app_id']
+        tape = MagicMock()
+        tape.post.return_value.status_code = 200
+        tape.post.return_value.content = json_dumps({'items': [self.record], 'total': 1})
+        self.conn = connect(':memory:')
+        self.storage = CachedItemStorage(self.conn, tape)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_cache_app(self):
+        self.storage.cache_app(self.app_id, ['status', 'type'], 'title')
+        self.storage.init_cache()
+        item = self.storage.get_item(self.app_id, self.record['record_id'])
+        self.assertEqual(self.record['record_id'], item.record_id)
+        indexes = [row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+            (f'podio_app_{self.app_id}', ))]
+        self.assertIn(f'idx_{self.app_id}_natural_key', indexes)
+        self.assertIn(f'idx_{self.app_id}_status', indexes)
+        self.assertIn(f'idx_{self.app_id}_extra_fields', indexes)
+
+    def test_cache_app_rolls_back_on_error(self):
+        self.storage.podio.post.side_effect = RuntimeError('download failed')
+        with self.assertRaises(RuntimeError):
+            self.storage.cache_app(self.app_id, ['status'], 'title')
+        self.assertFalse(self.conn.in_transaction)
@@ -1,18 +1,34 @@
+import io
 import json
 import os
+import pickle
 from pathlib import Path
+from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 
 from turbotape.helpers import (
     upload_file,
+    upload_files,
+    save_records,
+    guess_mimetype,
     iterate_array,
     iterate_resource,
+    iterate_resource_pages,
     intersection,
+    intersection_sorted,
     union,
+    json_loads,
+    json_dumps,
+    SearchableList,
+    load_complete_app,
+    normalize_search_text,
+    _normalize_short_search_text,
 )
+from turbotape.records import Record
 
-from turbotape.session import create_tape_session
+from turbotape.session import TapeSession, create_tape_session
 
 
 @pytest.mark.skip(reason="no way of automatically testing this")
@@ -25,16 +41,141 @@ def test_upload_file():
     print(res)
 
 
+def test_upload_files():
+    tape = MagicMock()
+    tape.post.side_effect = lambda url, data, files: MagicMock(
+        content=json_dumps({'file_id': len(files['file'][1])}))
+    res = upload_files(tape, [
+        (1, 'files', b'a', 'a.txt'),
+        (2, 'files', b'bb', 'b.txt', False),
+    ])
+    assert [1, 2] == [el['file_id'] for el in res]
+    assert 2 == tape.post.call_count
+    assert 1 == tape.put.call_count
+
+
+def _upload_with_one_failure(raw_data):
+    bodies = []
+
+    def send(request, **kwargs):
+        body = request.body.read() if hasattr(request.body, 'read') else request.body
+        bodies.append(body)
+        response = requests.Response()
+        response.status_code = 503 if len(bodies) == 1 else 200
+        response._content = json_dumps({'file_id': 1}).encode('utf-8')
+        return response
+
+    tape = TapeSession('key')
+    with patch('requests.Session.send', side_effect=send), patch('turbotape.session.sleep'):
+        res = upload_file(tape, 1, 'files', raw_data, 'a.txt', replace_file_field=False)
+    assert {'file_id': 1} == res
+    return bodies
+
+
+def test_upload_file_retry_sends_whole_file():
+    bodies = _upload_with_one_failure(io.BytesIO(b'file content'))
+    assert 2 == len(bodies)
+    assert b'file content' in bodies[1]
+
+
+def test_upload_file_retry_streamed(monkeypatch):
+    toolbelt = pytest.importorskip('requests_toolbelt')
+    monkeypatch.setattr('turbotape.helpers.MultipartEncoder', toolbelt.MultipartEncoder)
+    bodies = _upload_with_one_failure(io.BytesIO(b'file content'))
+    assert 2 == len(bodies)
+    assert bodies[0] == bodies[1]
+    assert b'file content' in bodies[1]
+
+
+class StubEncoder:
+    def __init__(self, fields, boundary):
+        self.fields = fields
+        self.boundary = boundary
+
+    def read(self, size=-1):
+        return self.fields['file'][1].read(size)
+
+
+@pytest.mark.parametrize('session_class', [requests.Session, MagicMock])
+def test_upload_file_streamed_other_session(monkeypatch, session_class):
+    monkeypatch.setattr('turbotape.helpers.MultipartEncoder', StubEncoder)
+    session = session_class()
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'{"file_id": 1}'
+    session.post = MagicMock(return_value=response)
+    upload_file(session, 1, 'files', io.BytesIO(b'file content'), 'a.txt',
+                replace_file_field=False)
+    body = session.post.call_args.kwargs['data']
+    assert isinstance(body, StubEncoder)
+    assert b'file content' == body.read()
+
+
+def test_save_records():
+    tape = MagicMock()
+    records = [make_record(i, 'Title %d' % i) for i in range(5)]
+    for record in records:
+        record['title'] = 'Changed'
+    save_records(records, tape, concurrency=2)
+    assert 5 == tape.put.call_count
+    assert {'title': 'Changed'} == tape.put.call_args.kwargs['json']
+
+
+def test_guess_mimetype():
+    assert 'application/pdf' == guess_mimetype('.pdf')
+    assert guess_mimetype('') is None
+    assert 'application/x-tar' == guess_mimetype('.tar.gz')
+
+
+def test_upload_file_mimetype():
+    tape = MagicMock()
+    tape.post.return_value = MagicMock(content=json_dumps({'file_id': 1}))
+    upload_file(tape, 1, 'files', b'a', 'Backup.TAR.GZ', replace_file_field=False)
+    assert 'application/x-tar' == tape.post.call_args.kwargs['files']['file'][2]
+
+
 class TestIterateArray:
 
     def test_iterate_array(self):
-        pass
+        def get(url, params):
+            offset = params['offset']
+            elements = list(range(offset, min(offset + params['limit'], 5)))
+            return MagicMock(status_code=200, content=json_dumps(elements))
+        client = MagicMock()
+        client.get.side_effect = get
+        assert [0, 1, 2, 3, 4] == list(iterate_array(client, 'https://example.com', limit=2))
+        assert 3 == client.get.call_count
+        client.get.reset_mock()
+        assert [0, 1, 2, 3, 4] == list(iterate_array(client, 'https://example.com', limit=5))
+        assert 2 == client.get.call_count
 
 
 class TestIterateResource:
 
-    def test_iterate_resource(self):
-        pass
+    @pytest.fixture
+    def client(self):
+        def post(url, json):
+            offset = json['offset']
+            items = [{'item_id': i} for i in range(offset, min(offset + json['limit'], 5))]
+            resp = MagicMock(status_code=200)
+            resp.content = json_dumps({'items': items, 'total': 5})
+            return resp
+        client = MagicMock()
+        client.post.side_effect = post
+        return client
+
+    def test_iterate_resource(self, client):
+        res = iterate_resource(client, 'https://example.com', limit=2)
+        assert [0, 1, 2, 3, 4] == [el['item_id'] for el in res]
+
+    @pytest.mark.parametrize('concurrency', [1, 3])
+    def test_iterate_resource_concurrency(self, client, concurrency):
+        res = iterate_resource(client, 'https://example.com', limit=1, concurrency=concurrency)
+        assert [0, 1, 2, 3, 4] == [el['item_id'] for el in res]
+
+    def test_iterate_resource_pages(self, client):
+        pages = list(iterate_resource_pages(client, 'https://example.com', limit=2))
+        assert [2, 2, 1] == [len(page) for page in pages]
 
 
 class TestSetOpsResource:
@@ -44,7 +185,151 @@ class TestSetOpsResource:
         assert 1 == len(res)
         assert 2 == res[0]
 
+    def test_intersection_keeps_order(self):
+        assert [5, 3, 1] == intersection([5, 4, 3, 2, 1], [1, 3, 5, 7], [1, 3, 5])
+        assert [] == intersection([1, 2], [3], list(range(1000)))
+
+    def test_intersection_sorted(self):
+        assert [2] == intersection_sorted([1, 2], [2, 3], [2, 4, 5])
+        assert [2, 5] == intersection_sorted([1, 2, 2, 5], [2, 2, 3, 5], [0, 2, 4, 5])
+        assert [] == intersection_sorted([1, 2], [3, 4])
+        assert [2] == intersection([1, 2], [2, 3], assume_sorted=True)
+
+    def test_intersection_sorted_gallop(self):
+        big = list(range(0, 10000, 3))
+        assert [0, 3, 9999] == intersection_sorted([0, 1, 3, 3, 9999], big)
+        assert [] == intersection_sorted([10001], big)
+
     def test_union(self):
         res = union([1, 2], [2, 3], [2, 4, 5])
         assert 5 == len(res)
-        assert 1 == res[0]
\ No newline at end of file
+        assert 1 == res[0]
+        assert [5, 1, 4, 2] == union([5, 1], [4, 1, 2, 5])
+
+
+class TestJson:
+
+    def test_json_roundtrip(self):
+        data = {'item_id': 1, 'title': 'Bow of boat', 'values': [1.5, None, True]}
+        assert data == json_loads(json_dumps(data))
+
+    def test_json_loads_bytes(self):
+        assert {'a': 'ü'} == json_loads('{"a": "ü"}'.encode('utf-8'))
+
+    def test_json_dumps_returns_str(self):
+        assert isinstance(json_dumps({'a': 1}), str)
+
+
+def make_record(record_id, title, color=None):
+    fields = [{'external_id': 'title', 'type': 'text', 'values': [{'value': title}]}]
+    if color is not None:
+        fields.append({'external_id': 'color', 'type': 'text', 'values': [{'value': color}]})
+    return Record({'record_id': record_id, 'fields': fields})
+
+
+class TestSearchableList:
+
+    @pytest.fixture
+    def items(self):
+        items = SearchableList()
+        items.append(make_record(1, 'My little Pony', 'Pink'))
+        items.append(make_record(2, 'Rainbow Dash', 'Blue'))
+        items.append(make_record(3, 'my little pony ', 'blue'))
+        items.append(make_record(4, 'Applejack'))
+        return items
+
+    def test_search(self, items):
+        res = items.search('title', 'MY LITTLE PONY')
+        assert [1, 3] == [el.record_id for el in res]
+        assert [] == items.search('title', 'Fluttershy')
+        assert [] == items.search('unknown', 'Fluttershy')
+
+    def test_search_first(self, items):
+        assert 2 == items.search_first('color', 'blue').record_id
+        assert items.search_first('color', 'green') is None
+
+    def test_search_multiple(self, items):
+        res = items.search_multiple({'title': 'my little pony', 'color': 'blue'})
+        assert [3] == [el.record_id for el in res]
+        res = items.search_multiple({'title': 'applejack', 'color': 'pink'},
+                                    mode=SearchableList.SEARCH_OR)
+        assert [1, 4] == sorted(el.record_id for el in res)
+
+    def test_search_multiple_no_match(self, items):
+        assert [] == items.search_multiple({'title': 'my little pony', 'color': 'green'})
+        res = items.search_multiple({'title': 'my little pony', 'color': 'green'},
+                                    mode=SearchableList.SEARCH_OR)
+        assert [1, 3] == sorted(el.record_id for el in res)
+
+    def test_search_batch(self, items):
+        res = items.search_batch([
+            {'title': 'my little pony', 'color': 'blue'},
+            {'color': 'Blue'},
+            {'title': 'Fluttershy'},
+        ])
+        assert [[3], [2, 3], []] == [sorted(el.record_id for el in r) for r in res]
+
+    def test_search_batch_matches_search_multiple(self, items):
+        queries = [{'title': ['my little pony']}, {'color': 'BLUE '}, {'color': 'blue'}]
+        for mode in [SearchableList.SEARCH_AND, SearchableList.SEARCH_OR]:
+            expected = [items.search_multiple(query, mode=mode) for query in queries]
+            assert expected == items.search_batch(queries, mode=mode)
+        assert 4 == len(items._op_cache)
+
+    def test_search_multiple_cache(self, items):
+        query = {'title': 'my little pony', 'color': 'blue'}
+        assert [3] == [el.record_id for el in items.search_multiple(query)]
+        assert 1 == len(items._op_cache)
+        assert [3] == [el.record_id for el in items.search_multiple(query)]
+        items.append(make_record(5, 'My little pony', 'Blue'))
+        assert 0 == len(items._op_cache)
+        assert [3, 5] == sorted(el.record_id for el in items.search_multiple(query))
+
+    def test_search_does_not_change_index(self, items):
+        items.search_multiple({'title': 'nothing', 'color': 'nothing'},
+                              mode=SearchableList.SEARCH_OR)
+        assert 'nothing' not in items.search_index['title']
+
+    def test_finalize(self, items):
+        items.finalize()
+        assert [1, 3] == [el.record_id for el in items.search('title', 'my little pony')]
+        items.append(make_record(5, 'My little pony'))
+        assert [1, 3, 5] == [el.record_id for el in items.search('title', 'my little pony')]
+        res = items.search_multiple({'title': 'my little pony', 'color': 'blue'})
+        assert [3] == [el.record_id for el in res]
+
+    def test_pickle(self, items):
+        copied = pickle.loads(pickle.dumps(items))
+        assert [1, 3] == [el.record_id for el in copied.search('title', 'my little pony')]
+        copied.append(make_record(5, 'My little pony'))
+        assert [1, 3, 5] == [el.record_id for el in copied.search('title', 'my little pony')]
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_load_complete_app(processes):
+    records = [make_record(i, f'Pony {i % 3}').item_data for i in range(10)]
+    client = MagicMock()
+    client.post.return_value = MagicMock(
+        status_code=200, content=json_dumps({'items': records, 'total': 10}))
+    items = load_complete_app(client, 1, processes=processes)
+    assert 10 == len(items)
+    assert [1, 4, 7] == [el.record_id for el in items.search('title', 'pony 1')]
+
+
+def test_search_list_values():
+    items = SearchableList()
+    record = make_record(1, 'Rarity')
+    record.item_data['fields'].append({
+        'external_id': 'friends', 'type': 'app',
+        'values': [{'value': {'item_id': 7}}, {'value': {'item_id': 8}}]})
+    items.append(record)
+    assert [1] == [el.record_id for el in items.search('friends', 8)]
+    assert [] == items.search('friends', '[7, 8]')
+
+
+def test_normalize_search_text():
+    _normalize_short_search_text.cache_clear()
+    assert 'blue' == normalize_search_text(' Blue ')
+    long_text = ' Lorem Ipsum ' * 20
+    assert long_text.strip().lower() == normalize_search_text(long_text)
+    assert 1 == _normalize_short_search_text.cache_info().currsize
@@ -1,26 +1,35 @@
+import copy
 import os
-import json
 import datetime
 from pathlib import Path
 
 import pytest
 
+from turbotape.helpers import json_loads
 from turbotape.records import (
     fetch_field,
+    find_mediator,
     Record,
     CategoryMediator,
+    DateMediator,
+    ContactMediator,
+    ImageMediator,
 )
 
 
+@pytest.fixture(scope='module')
+def _parsed_test_record():
+    json_path = Path(__file__).parent / 'test_record.json'
+    return json_loads(json_path.read_bytes())
+
+
 @pytest.fixture
-def test_record():
+def test_record(_parsed_test_record):
     """
-    Fixture for anything that needs test_record.json to be tested.
+    Fixture for anything that needs test_record.json to be tested. The file is
+    parsed once, every test gets its own copy to modify.
     """
-    json_path = Path(__file__).parent / 'test_record.json'
-    with open(json_path, mode='r') as fh:
-        test_record = json.load(fh)
-        return test_record
+    return copy.deepcopy(_parsed_test_record)
 
 
 class TestCategoryMediator:
@@ -47,6 +56,11 @@ class TestCategoryMediator:
             }
         }]
 
+    def test_update_category_id_and_list(self, my_field, my_mediator):
+        assert ['Complete'] == [v['value']['text'] for v in my_mediator.update(my_field, 48993)]
+        res = my_mediator.update(my_field, [48993, 'Complete', 'does not exist'])
+        assert [48993, 48993] == [v['value']['id'] for v in res]
+
     def test_fetch_category(self, my_mediator):
         assert \
             [(1, "Entered"), (2, "Accepted"), (3, "Rejected")] == \
@@ -70,6 +84,37 @@ class TestCategoryMediator:
         assert [2] == res
 
 
+def test_find_mediator_returns_shared_instance():
+    mediator = find_mediator({'type': 'category'})
+    assert isinstance(mediator, CategoryMediator)
+    assert mediator is find_mediator({'type': 'category'})
+    with pytest.raises(NotImplementedError):
+        find_mediator({'type': 'unknown'})
+
+
+def test_date_mediator_update():
+    mediator = DateMediator()
+    assert [{'start': '2018-07-27 01:00:00'}] == mediator.update({}, '2018-07-27 01:00:00')
+    assert [{'start': '2018-07-27 01:00:00'}] == mediator.update({}, '2018-07-27T01:00')
+    assert [{'start': '2018-07-27 01:00:00'}] == mediator.update({}, '27 July 2018 1:00')
+    assert [{'start': '2018-07-27 01:00:00'}] \
+        == mediator.update({}, datetime.datetime(2018, 7, 27, 1, 0))
+
+
+def test_contact_mediator_fetch():
+    field = {'values': [{'value': {'profile_id': 1}}, {'value': {'profile_id': 2}}]}
+    assert {'profile_id': 1} == ContactMediator().fetch(field)
+    assert [1, 2] == [v['profile_id'] for v in ContactMediator().fetch(field, 'all')]
+    assert ContactMediator().fetch({'values': []}) is None
+
+
+def test_image_mediator_update():
+    mediator = ImageMediator()
+    values = mediator.update({}, [4388, 4389])
+    assert [4388, 4389] == mediator.fetch({'values': values})
+    assert [{'value': {'file_id': 4388}}] == mediator.update({}, 4388)
+
+
 class TestFetchField:
 
     def test_get_field_not_found(self, test_record):
@@ -84,6 +129,9 @@ class TestFetchField:
         # "right" thing from  the beginning (using '_' instead of '-').
         assert '4.0000' == fetch_field('story_points', test_record)
 
+    def test_fetch_field_from_record(self, test_record):
+        assert "UI bug on login screen (Sample)" == fetch_field('title', Record(test_record))
+
     def test_get_text_field(self, test_record):
         assert "UI bug on login screen (Sample)" == fetch_field('title', test_record)
 
@@ -146,6 +194,12 @@ class TestRecord:
         assert '111340631' == my_record.record_id__str
         assert '111340631' == my_record.record_id__str
     
+    def test_unique_id(self):
+        record = Record({'link': 'https://tapeapp.com/org/record/4711', 'fields': []})
+        assert 4711 == record.unique_id
+        assert 4711 == record.unique_id
+        assert '4711' == record.unique_id__str
+
     def test_files(self, my_record):
         """
         Try if we can get ALL files attached to a record somewhere.
@@ -174,6 +228,26 @@ class TestRecord:
         assert f'https://tapeapp.com/kollaborateure/record/111340631' \
                 == my_record.link
     
+    def test_field_index(self, my_record):
+        assert "UI bug on login screen (Sample)" == my_record['title']
+        index = my_record.get_field_index()
+        assert index is my_record.get_field_index()
+        my_record.item_data['fields'].append(
+            {'external_id': 'extra', 'type': 'text', 'values': [{'value': 'Added'}]})
+        assert 'Added' == my_record['extra']
+        assert index is not my_record.get_field_index()
+
+    def test_mapping_keys(self, my_record):
+        assert 'title' in list(my_record)
+        assert len(my_record.item_data['fields']) == len(my_record)
+        assert 'title' in my_record
+        assert 'title__unformatted' in my_record
+        assert 'does_not_exist' not in my_record
+
+    def test_as_podio_dict_selected_fields(self, my_record):
+        res = my_record.as_podio_dict(fields=['title', 'calc', 'does_not_exist'])
+        assert {'title': 'UI bug on login screen (Sample)'} == res
+
     def test__getitem__(self, my_record):
         assert "Bow of boat" == my_record['name']
 
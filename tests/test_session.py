@@ -1,10 +1,22 @@
+import datetime
 import json
 import os
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
 
 from turbotape.session import (
     try_environment_token,
     create_tape_session,
+    TapeSession,
+    TapeResponse,
+    load_token,
+    find_token,
+    retry_wait_seconds,
+    rate_limit_wait_seconds,
+    jittered_wait_seconds,
+    parse_retry_reset,
 )
 
 
@@ -21,4 +33,111 @@ class TestSession:
             assert "bearer" == try_environment_token()["token_type"]
 
     def test_try_environment_token_not_set(self):
-        assert None == try_environment_token()
\ No newline at end of file
+        assert None == try_environment_token()
+
+
+class TestRetryWait:
+
+    def test_retry_wait_seconds(self):
+        assert [3.0, 6.0, 12.0, 24.0] == [retry_wait_seconds(n) for n in range(4)]
+        assert 60.0 == retry_wait_seconds(10)
+
+    def test_rate_limit_retry_after(self):
+        response = MagicMock(headers={'Retry-After': '7'})
+        assert 7.0 == rate_limit_wait_seconds(response, 0)
+
+    def test_jittered_wait_seconds(self):
+        for _ in range(20):
+            assert 3.0 <= jittered_wait_seconds(1) <= 6.0
+
+    def test_parse_retry_reset(self):
+        expected = datetime.datetime(2024, 1, 31, 12, 0, tzinfo=datetime.timezone.utc)
+        assert expected == parse_retry_reset('2024-01-31 12:00:00')
+        assert expected == parse_retry_reset('2024-01-31T12:00:00Z')
+
+    def test_rate_limit_without_headers(self):
+        response = MagicMock(headers={})
+        assert 6.0 == rate_limit_wait_seconds(response, 1)
+
+
+def test_request_serializes_json_body():
+    session = TapeSession('key', robust=False)
+    with patch('requests.Session.request') as request:
+        session.put('https://example.com', json={'title': 'Grüße'})
+    kwargs = request.call_args.kwargs
+    assert 'json' not in kwargs
+    assert {'title': 'Grüße'} == json.loads(kwargs['data'].decode('utf-8'))
+    assert 'application/json' == kwargs['headers']['Content-Type']
+
+
+def test_request_json_body_edge_cases():
+    session = TapeSession('key', robust=False)
+    with patch('requests.Session.request') as request:
+        session.put('https://example.com', json={1: 'a'})
+    assert {'1': 'a'} == json.loads(request.call_args.kwargs['data'])
+    for body in [{'date': None}, {'title': 'nullable NaN Infinity'}]:
+        with patch('requests.Session.request') as request:
+            session.put('https://example.com', json=body)
+        assert 'json' not in request.call_args.kwargs
+        assert body == json.loads(request.call_args.kwargs['data'])
+    with patch('requests.Session.send') as send:
+        with pytest.raises(TypeError):
+            session.put('https://example.com', json={'date': datetime.datetime(2020, 1, 1)})
+    send.assert_not_called()
+    with patch('requests.Session.send') as send:
+        with pytest.raises(requests.exceptions.InvalidJSONError):
+            session.put('https://example.com', json={'value': float('nan')})
+    send.assert_not_called()
+
+
+def test_request_logs_json_body(caplog):
+    session = TapeSession('key')
+    response = requests.Response()
+    response.status_code = 404
+    response._content = b'{}'
+    with patch('requests.Session.send', return_value=response), \
+            patch('turbotape.session.sleep'):
+        session.put('https://example.com', json={'title': 'x'})
+    assert "* json: {'title': 'x'}" in caplog.text
+
+
+def test_shared_tape_client():
+    session = create_tape_session(credentials='key', shared=True)
+    assert session is create_tape_session(credentials='key', shared=True)
+    assert session is not create_tape_session(credentials='key')
+    assert session is not create_tape_session(credentials='other key', shared=True)
+
+
+def test_load_token(tmp_path):
+    creds_file = tmp_path / 'tape_credentials.txt'
+    creds_file.write_text(' user_key_abc \r\nsecond line\n', encoding='utf-8')
+    assert 'user_key_abc' == load_token(creds_file)
+    creds_file.write_text('', encoding='utf-8')
+    assert '' == load_token(str(creds_file))
+
+
+def test_create_tape_session_without_key(tmp_path):
+    with patch.dict('os.environ', {'TAPE_API_KEY': ''}):
+        with pytest.raises(FileNotFoundError):
+            create_tape_session(credentials_file=tmp_path / 'missing.txt')
+
+
+def test_response_json_uses_json_loads():
+    session = TapeSession('key', robust=False)
+    response = requests.Response()
+    response._content = b'{"title": "Gr\xc3\xbc\xc3\x9fe"}'
+    with patch('requests.Session.send', return_value=response):
+        resp = session.get('https://example.com')
+    assert {'title': 'Grüße'} == resp.json()
+    assert isinstance(resp, TapeResponse)
+    assert 'json' not in vars(resp)
+
+
+def test_find_token(tmp_path):
+    creds_file = tmp_path / 'creds.txt'
+    creds_file.write_text('file_key\n', encoding='utf-8')
+    with patch.dict('os.environ', {'TAPE_API_KEY': 'env_key'}):
+        assert 'given_key' == find_token(creds_file, 'given_key')
+        assert 'env_key' == find_token(creds_file)
+    with patch.dict('os.environ', {'TAPE_API_KEY': ''}):
+        assert 'file_key' == find_token(creds_file)